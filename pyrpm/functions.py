@@ -1315,17 +1315,30 @@ def run_main(main):
         dohotshot = 1
         sys.argv.pop(1)
     if dohotshot:
-        import hotshot, hotshot.stats
-        htfilename = mkstemp_file("/tmp", tmpprefix)[1]
-        prof = hotshot.Profile(htfilename)
-        prof.runcall(main)
-        prof.close()
-        del prof
-        log.info2("Starting profil statistics. This takes some time...")
-        s = hotshot.stats.load(htfilename)
+        try:
+            # python-2.5 and newer: profiler in C, no temp file needed
+            import cProfile, pstats
+        except ImportError:
+            cProfile = None
+        htfilename = None
+        if cProfile != None:
+            prof = cProfile.Profile()
+            prof.runcall(main)
+            log.info2("Starting profil statistics. This takes some time...")
+            s = pstats.Stats(prof)
+        else:
+            import hotshot, hotshot.stats
+            htfilename = mkstemp_file("/tmp", tmpprefix)[1]
+            prof = hotshot.Profile(htfilename)
+            prof.runcall(main)
+            prof.close()
+            del prof
+            log.info2("Starting profil statistics. This takes some time...")
+            s = hotshot.stats.load(htfilename)
         s.strip_dirs().sort_stats("time").print_stats(100)
         s.strip_dirs().sort_stats("cumulative").print_stats(100)
-        os.unlink(htfilename)
+        if htfilename != None:
+            os.unlink(htfilename)
     else:
         return main()
 
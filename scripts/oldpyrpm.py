@@ -122,6 +122,13 @@ if sys.version_info < (2, 2):
 import os, os.path, zlib, gzip, errno, re, time, signal
 from types import IntType, ListType
 from struct import pack, unpack
+from array import array
+# Timer for the "Needed ... seconds" output. This is wall clock time, so
+# that work done by worker processes is also accounted for.
+if hasattr(time, "perf_counter"):
+    timer = time.perf_counter
+else:
+    timer = time.time
 if sys.version_info < (3, 0):
     import md5
     import sha as sha1
@@ -397,6 +404,71 @@ def getChecksum(fd, digest="md5"):
 def getMD5(fpath):
     return getChecksum(fpath, "md5")
 
+def getChecksumTuple(args):
+    """Call getChecksum() with a (filename, digest) tuple, this is used
+    for multiprocessing.Pool.imap()."""
+    return getChecksum(args[0], args[1])
+
+def getStatKey(path):
+    """Return a string that changes whenever the file at path is modified
+    or replaced, or None if the file cannot be accessed."""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return "%d %d %d %d" % (st.st_ino, st.st_size, st.st_mtime, st.st_ctime)
+
+def readChecksumCache(filename):
+    """Read a file checksum cache written by writeChecksumCache() and
+    return a dict mapping filenames to (statkey, checksum) tuples."""
+    cache = {}
+    try:
+        fd = open(filename, "r")
+    except IOError:
+        return cache
+    for line in fd.readlines():
+        l = line[:-1].split(" ", 5)
+        if len(l) != 6:
+            continue
+        cache[l[5]] = (" ".join(l[1:5]), l[0])
+    fd.close()
+    return cache
+
+def writeChecksumCache(filename, cache):
+    """Write a dict mapping filenames to (statkey, checksum) tuples as
+    file checksum cache."""
+    lines = []
+    for (path, entry) in cache.iteritems():
+        lines.append("%s %s %s\n" % (entry[1], entry[0], path))
+    lines.sort()
+    (fd, tmp) = mkstemp_file(pathdirname(filename), special=1)
+    fd.write("".join(lines))
+    fd.close()
+    os.rename(tmp, filename)
+
+class ChecksumWriter:
+    """Write all data to fd and compute the checksum of it on the way, so
+    the written file does not need to be read in again for a checksum."""
+
+    def __init__(self, fd, digest="md5"):
+        self.fd = fd
+        # GzipFile takes the filename for its header from this:
+        self.name = getattr(fd, "name", "")
+        if digest == "md5":
+            self.ctx = md5.new()
+        else:
+            self.ctx = sha1.new()
+
+    def write(self, data):
+        self.ctx.update(data)
+        self.fd.write(data)
+
+    def close(self):
+        self.fd.close()
+
+    def hexdigest(self):
+        return self.ctx.hexdigest()
+
 supported_signals = [signal.SIGINT, signal.SIGTERM, signal.SIGHUP]
 #supported_signals.extend([signal.SIGSEGV, signal.SIGBUS, signal.SIGABRT,
 # signal.SIGILL, signal.SIGFPE])
@@ -583,6 +655,77 @@ class GzipFile(gzip.GzipFile):
         if fname:
             self.fileobj.write(fname + "\000")
 
+class PigzFile:
+    """Compress all written data with an external pigz process, which uses
+    all cpus for compression, and write the result into the file object
+    fd. A separate thread copies the data from pigz into fd. close()
+    raises an IOError if pigz failed or the data could not be written."""
+
+    def __init__(self, fd, pigz="pigz"):
+        from subprocess import Popen, PIPE
+        import threading
+        self.proc = Popen([pigz, "-c", "-9"], stdin=PIPE, stdout=PIPE)
+        self.error = None
+        self.thread = threading.Thread(target=self.__copy, args=(fd,))
+        self.thread.start()
+
+    def __copy(self, fd):
+        fileno = self.proc.stdout.fileno()
+        try:
+            data = os.read(fileno, 65536)
+            while data:
+                fd.write(data)
+                data = os.read(fileno, 65536)
+        except:
+            # Keep the error for close() and stop pigz, otherwise it
+            # blocks on its full output pipe and write() hangs.
+            self.error = sys.exc_info()
+            self.__kill()
+
+    def __kill(self):
+        try:
+            os.kill(self.proc.pid, signal.SIGKILL)
+        except OSError:
+            pass
+
+    def write(self, data):
+        try:
+            self.proc.stdin.write(data)
+        except IOError:
+            # pigz is gone, close() reports why.
+            err = sys.exc_info()
+            self.close()
+            raise err[0], err[1], err[2]
+
+    def close(self):
+        if self.proc.stdin.closed:
+            return
+        try:
+            self.proc.stdin.close()
+        except IOError:
+            self.__kill()
+        self.thread.join()
+        ret = self.proc.wait()
+        if self.error != None:
+            (t, v, tb) = self.error
+            raise t, v, tb
+        if ret != 0:
+            raise IOError, "pigz failed with exit status %d" % ret
+
+def findProgram(name):
+    """Return the full path of the executable name in $PATH or None."""
+    for dirname in os.environ.get("PATH", "/usr/bin:/bin").split(":"):
+        if dirname and os.access(dirname + "/" + name, os.X_OK):
+            return dirname + "/" + name
+    return None
+
+def openGzipWrite(fd):
+    """Return a file object that writes gzip compressed data into fd."""
+    pigz = findProgram("pigz")
+    if pigz != None:
+        return PigzFile(fd, pigz)
+    return GzipFile(fileobj=fd, mode="wb")
+
 
 cachedir = "/var/cache/pyrpm/"
 opensuse = 0
@@ -1624,6 +1767,9 @@ class HdrIndex:
             return value[0]
         return value
 
+# md5sum as hex string, also used as version of some deps
+md5hashrc = re.compile("^[a-z0-9]{32}$")
+
 class ReadRpm: # pylint: disable-msg=R0904
     """Read (Linux) rpm packages."""
 
@@ -1641,6 +1787,8 @@ class ReadRpm: # pylint: disable-msg=R0904
         self.gid = None
         self.relocated = None
         self.rpmgroup = None
+        self.filepaths = None # cached result of getFilepaths()
+        self.epochstr = None # cached epoch string for getEpoch()
         # Further data posibly created later on:
         #self.leaddata = first 96 bytes of lead data
         #self.sigdata = binary blob of signature header
@@ -1685,6 +1833,12 @@ class ReadRpm: # pylint: disable-msg=R0904
                     return 1
                 if offset:
                     self.fd.seek(offset, 1)
+                elif headerend:
+                    # Only the rpm header is needed, so read all of it
+                    # with one read() call instead of many small ones.
+                    fd = self.fd
+                    self.fd = StringIO(fd.read(headerend))
+                    fd.close()
         return None
 
     def closeFd(self):
@@ -1867,6 +2021,8 @@ class ReadRpm: # pylint: disable-msg=R0904
         return hdr
 
     def setHdr(self):
+        self.filepaths = None
+        self.epochstr = None
         self.__getitem__ = self.hdr.__getitem__
         self.__delitem__ = self.hdr.__delitem__
         self.__setitem__ = self.hdr.__setitem__
@@ -2131,6 +2287,31 @@ class ReadRpm: # pylint: disable-msg=R0904
         #return ret
         # pyrex-code-end
 
+    def getFilepaths(self):
+        """Return (basenames, dirnames) with one dirname entry per file or
+        (None, None) if the package has no files. This is cached as it is
+        needed to add and again to remove a package from a FilenamesList."""
+        if self.filepaths != None:
+            return self.filepaths
+        basenames = self["basenames"]
+        if basenames != None:
+            dirnames = self["dirnames"]
+            # python-only
+            dirnames = [ dirnames[di] for di in self["dirindexes"] ]
+            # python-only-end
+            # pyrex-code
+            #dirnames2 = []
+            #for di in self["dirindexes"]:
+            #    dirnames2.append(dirnames[di])
+            #dirnames = dirnames2
+            # pyrex-code-end
+            self.filepaths = (basenames, dirnames)
+        elif self["oldfilenames"] != None:
+            self.filepaths = genBasenames2(self["oldfilenames"])
+        else:
+            self.filepaths = (None, None)
+        return self.filepaths
+
     def readPayload(self, func, filenames=None, extract=None, db=None):
         self.__openFd(96 + self.sigdatasize + self.hdrdatasize)
         # pylint: disable-msg=W0612
@@ -2224,10 +2405,13 @@ class ReadRpm: # pylint: disable-msg=R0904
         return None
 
     def getEpoch(self, default="0"):
-        e = self["epoch"]
-        if e == None:
-            return default
-        return str(e[0])
+        # This is called for each version compare, so cache the string.
+        if self.epochstr == None:
+            e = self["epoch"]
+            if e == None:
+                return default
+            self.epochstr = str(e[0])
+        return self.epochstr
 
     def getArch(self):
         if self.issrc:
@@ -2530,7 +2714,6 @@ class ReadRpm: # pylint: disable-msg=R0904
                 if (i in self["name"] or i in self["version"] or
                     i in self["release"]):
                     self.printErr("name/version/release contains wrong char")
-            matchhash = re.compile("^[a-z0-9]{32}$")
             for i in self.hdr.get("provideversion", []) + \
                 self.hdr.get("requireversion", []) + \
                 self.hdr.get("obsoleteversion", []) + \
@@ -2542,7 +2725,7 @@ class ReadRpm: # pylint: disable-msg=R0904
                     self.printErr("wrong char [ ,\\t] in deps")
                 if i.count("-") >= 2:
                     self.printErr("too many '-' in deps")
-                if i[:1] and not i[:1].isdigit() and not matchhash.match(i) \
+                if i[:1] and not i[:1].isdigit() and not md5hashrc.match(i) \
                     and i != "%s-%s" % (self["version"], self["release"]):
                     self.printErr("dependency version starts " +
                         "with non-digit: %s" % i)
@@ -2736,11 +2919,12 @@ class ReadRpm: # pylint: disable-msg=R0904
 
         # Verify region headers have sane data. We do not support more than
         # one region header at this point.
+        hdrdata = self.hdrdata
         if self["immutable"] != None:
-            (tag, ttype, offset, count) = unpack("!4I", self.hdrdata[3][0:16])
+            (tag, ttype, offset, count) = unpack("!4I", hdrdata[3][0:16])
             if tag != rpmtag["immutable"][0] or ttype != RPM_BIN or count != 16:
                 self.printErr("region tag not at the beginning of the header")
-            elif offset + 16 != self.hdrdata[1]:
+            elif offset + 16 != hdrdata[1]:
                 self.printErr("wrong length of tag header detected")
         for (data, regiontag) in ((self["immutable"], rpmtag["immutable"][0]),
             (self.sig["header_signatures"], rpmsigtag["header_signatures"][0])):
@@ -2752,31 +2936,32 @@ class ReadRpm: # pylint: disable-msg=R0904
             if -offset % 16 != 0:
                 self.printErr("region has wrong offset")
             if (regiontag == rpmtag["immutable"][0] and
-                -offset // 16 != self.hdrdata[0]):
+                -offset // 16 != hdrdata[0]):
                 self.printErr("region tag %s only for partial header: %d, %d" \
-                    % (regiontag, self.hdrdata[0], -offset // 16))
+                    % (regiontag, hdrdata[0], -offset // 16))
 
         if self.nodigest:
             return 0
 
-        # sha1 of the header
         sha1header = self.sig["sha1header"]
+        md5sum = self.sig["md5"]
+        if sha1header or md5sum:
+            # Both digests start with the same header data, so join it
+            # only once and feed it with a single update() call.
+            #PY3: hdrblob = b"".join(hdrdata[2:5])
+            hdrblob = "".join(hdrdata[2:5])
+        # sha1 of the header
         if sha1header:
             ctx = sha1.new()
-            ctx.update(self.hdrdata[2])
-            ctx.update(self.hdrdata[3])
-            ctx.update(self.hdrdata[4])
+            ctx.update(hdrblob)
             if ctx.hexdigest() != sha1header:
                 self.printErr("wrong sha1: %s / %s" % (sha1header,
                     ctx.hexdigest()))
                 return 1
         # md5sum of header plus payload
-        md5sum = self.sig["md5"]
         if md5sum:
             ctx = md5.new()
-            ctx.update(self.hdrdata[2])
-            ctx.update(self.hdrdata[3])
-            ctx.update(self.hdrdata[4])
+            ctx.update(hdrblob)
             data = self.fd.read(65536)
             while data:
                 ctx.update(data)
@@ -2909,6 +3094,24 @@ def verifyRpm(filename, verify, strict, payload, nodigest, hdrtags, keepdata,
     rpm.closeFd()
     return rpm
 
+def verifyRpmTuple(args):
+    """Call verifyRpm() with a (filename, verify, strict, payload, nodigest,
+    useimportanttags, keepdata, headerend) tuple, this is used for
+    multiprocessing.Pool.imap(). The rpm itself is not passed back to the
+    main process, only the output of the checks is returned so that the
+    main process can print it in the order of the rpms."""
+    hdrtags = rpmtag
+    if args[5]:
+        hdrtags = importanttags
+    stdout = sys.stdout
+    sys.stdout = StringIO()
+    try:
+        verifyRpm(args[0], args[1], args[2], args[3], args[4], hdrtags,
+            args[6], args[7])
+        return sys.stdout.getvalue()
+    finally:
+        sys.stdout = stdout
+
 def extractRpm(filename, buildroot, owner=None, db=None):
     """Extract a rpm into a directory."""
     if isinstance(filename, basestring):
@@ -2952,20 +3155,22 @@ def ignoreBinary():
         "\.z$\n\.Z$\n\.zip$\n\.ttf$\n\.db$\n\.jar$\n\.pdf$\n\.sdf$\n\.war$\n" \
         "\.gsi$\n\.uqm$\n\.weight$\n\.ps$\n"
 
+binaryexts = {"cin":1, "ogg":1, "gz":1, "tgz":1, "tar":1, "taz":1, "tbz":1,
+    "bz2":1, "z":1, "Z":1, "zip":1, "ttf":1, "db":1, "jar":1, "pdf":1,
+    "sdf":1, "war":1, "gsi":1, "uqm":1, "weight":1, "ps":1}
+
 def isBinary(filename):
-    for i in (".cin", ".ogg", ".gz", ".tgz", ".tar", ".taz", ".tbz", ".bz2",
-        ".z", ".Z", ".zip", ".ttf", ".db", ".jar", ".pdf", ".sdf", ".war",
-        ".gsi", ".uqm", ".weight", ".ps"):
-        if filename.endswith(i):
-            return 1
-    return 0
+    i = filename.rfind(".")
+    if i < 0:
+        return 0
+    return filename[i + 1:] in binaryexts
 
 def explodeFile(filename, dirname, version):
     if filename.endswith(".tar.gz"):
-        explode = "z"
+        explode = "gz"
         dirn = filename[:-7]
     elif filename.endswith(".tar.bz2"):
-        explode = "j"
+        explode = "bz2"
         dirn = filename[:-8]
     else:
         return
@@ -2974,14 +3179,53 @@ def explodeFile(filename, dirname, version):
         newdirn = newdirn[:- len(version)]
     while newdirn[-1] in "-_.0123456789":
         newdirn = newdirn[:-1]
-    os.system("cd " + dirname + " && { tar x" + explode + "f " + filename \
-              + "; for i in * ; do test -d \"$i\" && mv \"$i\" " + newdirn \
-              + "; done; }")
+    # Unpack within this process instead of running tar. Entries with
+    # absolute paths or ".." are not extracted.
+    import tarfile
+    tar = tarfile.open(filename, "r:" + explode)
+    members = []
+    for member in tar.getmembers():
+        name = member.name
+        if name[:1] != "/" and ".." not in name.split("/"):
+            members.append(member)
+    if hasattr(tar, "extractall"):
+        tar.extractall(dirname, members)
+    else:
+        for member in members:
+            tar.extract(member, dirname)
+    tar.close()
+    # Move the unpacked top directory to newdirn. Like "mv" failures
+    # are only reported and the other entries are still moved.
+    for i in os.listdir(dirname):
+        src = dirname + "/" + i
+        if i[:1] == "." or not os.path.isdir(src):
+            continue
+        if os.path.normpath(src) == os.path.normpath(newdirn):
+            continue
+        try:
+            if os.path.isdir(newdirn):
+                os.rename(src, newdirn + "/" + i)
+            else:
+                os.rename(src, newdirn)
+        except OSError, e:
+            print "Cannot move %s to %s: %s" % (src, newdirn, e)
     return newdirn
 
 delim = "--- -----------------------------------------------------" \
     "---------------------\n"
 
+def getDiff(args, obuildroot, nbuildroot):
+    """Run diff (without a shell) and strip the buildroot prefixes from
+    the filenames in its "---"/"+++" lines. Like commands.getoutput()
+    the trailing newline is removed."""
+    from subprocess import Popen, PIPE, STDOUT
+    data = Popen(args, stdout=PIPE, stderr=STDOUT).communicate()[0]
+    data = ("\n" + data).replace("\n--- " + obuildroot, "\n--- ")
+    data = data.replace("\n+++ " + nbuildroot, "\n+++ ")[1:]
+    if data[-1:] == "\n":
+        data = data[:-1]
+    return data
+
 def diffTwoSrpms(oldsrpm, newsrpm, explode=None):
     from commands import getoutput
 
@@ -3011,10 +3255,6 @@ def diffTwoSrpms(oldsrpm, newsrpm, explode=None):
     obuildroot = orpm.buildroot = mkstemp_dir(tmpdir) + "/"
     nbuildroot = nrpm.buildroot = mkstemp_dir(tmpdir) + "/"
 
-    sed1 = "sed 's#^--- " + obuildroot + "#--- #'"
-    sed2 = "sed 's#^+++ " + nbuildroot + "#+++ #'"
-    sed = sed1 + " | " + sed2
-
     extractRpm(orpm, obuildroot)
     ofiles = orpm.getFilenames()
     ospec = orpm.getSpecfile(ofiles)
@@ -3057,13 +3297,14 @@ def diffTwoSrpms(oldsrpm, newsrpm, explode=None):
     if ospec != None and nspec != None:
         ospec = obuildroot + ofiles[ospec]
         nspec = nbuildroot + nfiles[nspec]
-        ret = ret + getoutput("diff -u " + ospec + " " + nspec + " | " + sed)
+        ret = ret + getDiff(["diff", "-u", ospec, nspec], obuildroot,
+            nbuildroot)
         os.unlink(ospec)
         os.unlink(nspec)
 
     # Diff the rest.
-    ret = ret + getoutput("diff -urN " + obuildroot + " " + nbuildroot + \
-        " | " + sed)
+    ret = ret + getDiff(["diff", "-urN", obuildroot, nbuildroot], obuildroot,
+        nbuildroot)
     os.system("rm -rf " + obuildroot + " " + nbuildroot)
     return ret
 
@@ -3236,7 +3477,10 @@ def genBasenames(oldfilenames):
     to verify rpm packages until now."""
     (basenames, dirindexes, dirnames) = ([], [], [])
     for filename in oldfilenames:
-        (dirname, basename) = pathsplit2(filename)
+        # inlined pathsplit2()
+        i = filename.rfind("/") + 1
+        dirname = filename[:i]
+        basename = filename[i:]
         dirindex = bsearch(dirname, dirnames)
         if dirindex < 0:
             dirindex = len(dirnames)
@@ -3248,9 +3492,10 @@ def genBasenames(oldfilenames):
 def genBasenames2(oldfilenames):
     (basenames, dirnames) = ([], [])
     for filename in oldfilenames:
-        (dirname, basename) = pathsplit2(filename)
-        basenames.append(basename)
-        dirnames.append(dirname)
+        # inlined pathsplit2()
+        i = filename.rfind("/") + 1
+        basenames.append(filename[i:])
+        dirnames.append(filename[:i])
     return (basenames, dirnames)
 
 
@@ -3264,28 +3509,12 @@ class FilenamesList:
     def addPkg(self, pkg):
         """Add all files from RpmPackage pkg to self."""
         path = self.path
-        basenames = pkg["basenames"]
-        if basenames != None:
-            dirindexes = pkg["dirindexes"]
-            dirnames = pkg["dirnames"]
-            for dirname in dirnames:
-                path.setdefault(dirname, {})
-            # python-only
-            dirnames = [ dirnames[di] for di in dirindexes ]
-            # python-only-end
-            # pyrex-code
-            #dirnames2 = []
-            #for di in dirindexes:
-            #    dirnames2.append(dirnames[di])
-            #dirnames = dirnames2
-            # pyrex-code-end
-        else:
-            if pkg["oldfilenames"] == None:
-                return
-            # genBasenames2() is called for addPkg() and removePkg()
-            (basenames, dirnames) = genBasenames2(pkg["oldfilenames"])
-            for dirname in dirnames:
-                path.setdefault(dirname, {})
+        (basenames, dirnames) = pkg.getFilepaths()
+        if basenames == None:
+            return
+        # pkg["dirnames"] lists each directory only once, so prefer it:
+        for dirname in pkg["dirnames"] or dirnames:
+            path.setdefault(dirname, {})
         if self.checkfileconflicts:
             for i in xrange(len(basenames)):
                 path[dirnames[i]].setdefault(basenames[i], []).append((pkg, i))
@@ -3295,23 +3524,9 @@ class FilenamesList:
 
     def removePkg(self, pkg):
         """Remove all files from RpmPackage pkg from self."""
-        basenames = pkg["basenames"]
-        if basenames != None:
-            dirindexes = pkg["dirindexes"]
-            dirnames = pkg["dirnames"]
-            # python-only
-            dirnames = [ dirnames[di] for di in dirindexes ]
-            # python-only-end
-            # pyrex-code
-            #dirnames2 = []
-            #for di in dirindexes:
-            #    dirnames2.append(dirnames[di])
-            #dirnames = dirnames2
-            # pyrex-code-end
-        else:
-            if pkg["oldfilenames"] == None:
-                return
-            (basenames, dirnames) = genBasenames2(pkg["oldfilenames"])
+        (basenames, dirnames) = pkg.getFilepaths()
+        if basenames == None:
+            return
         if self.checkfileconflicts:
             for i in xrange(len(basenames)):
                 self.path[dirnames[i]][basenames[i]].remove((pkg, i))
@@ -3321,8 +3536,8 @@ class FilenamesList:
 
     def searchDependency(self, name, returnall=0):
         """Return list of packages providing file with name."""
-        (dirname, basename) = pathsplit2(name)
-        ret = self.path.get(dirname, {}).get(basename, [])
+        i = name.rfind("/") + 1
+        ret = self.path.get(name[:i], {}).get(name[i:], [])
         if self.checkfileconflicts and returnall == 0:
             # python-only
             return [ r[0] for r in ret ]
@@ -3517,21 +3732,18 @@ class RpmRelations(dict):
 
         Stop when each remaining package has successor (implies a dependency
         loop)."""
-        i = 0
-        found = 0
-        while len(self) > 0:
-            pkg = self[i]
-            if len(self[pkg].post) == 0:
+        while self:
+            # Collect all current leaf nodes in one sweep and remove them
+            # afterwards, so the dict is not changed while iterating it.
+            leafs = []
+            for pkg in self:
+                if not self[pkg].post:
+                    leafs.append(pkg)
+            if not leafs:
+                break
+            for pkg in leafs:
                 list2.append(pkg)
                 self.remove(pkg)
-                found = 1
-            else:
-                i += 1
-            if i == len(self):
-                if found == 0:
-                    break
-                i = 0
-                found = 0
 
     def _calculateWeights2(self, pkg, leafs):
         """For each package generate a dict of all packages that depend on it.
@@ -3998,9 +4210,12 @@ def selectNewestRpm(rpms, arch_hash, verbose):
     """Select one package out of rpms that has the highest version
     number."""
     newest = rpms[0]
-    newestarch = arch_hash.get(newest.getArch(), 999)
+    if len(rpms) == 1:
+        return newest
+    archget = arch_hash.get
+    newestarch = archget(newest.getArch(), 999)
     for rpm in rpms[1:]:
-        rpmarch = arch_hash.get(rpm.getArch(), 999)
+        rpmarch = archget(rpm.getArch(), 999)
         if (rpmarch < newestarch or
             (rpmarch == newestarch and pkgCompare(newest, rpm) < 0)):
             if verbose > 4:
@@ -4051,21 +4266,29 @@ def getPkgsNewest(rpms, arch=None, arch_hash={}, # pylint: disable-msg=W0102
         # By name find the newest rpm and then decide if a noarch
         # rpm is the newest (and all others are deleted) or if an
         # arch-dependent rpm is newest (and all noarchs are removed).
+        # Removed rpms are collected in a hash and filtered out at the end.
+        removed = {}
         for rpms in h.itervalues():
             # set verbose to 0 as this is actually not selecting rpms:
             newest = selectNewestRpm(rpms, arch_hash, 0)
             if newest["arch"] == "noarch":
                 for r in rpms:
                     if r != newest:
-                        pkgs.remove(r)
+                        removed[r] = None
                         if verbose > 4:
                             print "Removed older rpm:", r.getFilename()
             else:
                 for r in rpms:
                     if r["arch"] == "noarch":
-                        pkgs.remove(r)
+                        removed[r] = None
                         if verbose > 4:
                             print "Removed older rpm:", r.getFilename()
+        if removed:
+            pkgs2 = []
+            for r in pkgs:
+                if r not in removed:
+                    pkgs2.append(r)
+            pkgs = pkgs2
     return pkgs
 
 def findRpms(dirname, uselstat=None, verbose=0):
@@ -4076,8 +4299,9 @@ def findRpms(dirname, uselstat=None, verbose=0):
     files = []
     while dirs:
         d = dirs.pop()
+        prefix = d + "/"
         for f in os.listdir(d):
-            path = "%s/%s" % (d, f)
+            path = prefix + f
             st = s(path)
             if S_ISREG(st.st_mode) and f[-4:] == ".rpm":
                 files.append(path)
@@ -4147,24 +4371,35 @@ class RpmCSV:
             self.pkglist = self.readCSV(data)
 
     def readCSV(self, filename):
-        lines = open(filename, "r").readlines()
+        fd = open(filename, "r")
         csv = []
-        crc = lines.pop()
-        if not crc.startswith("# crc: ") or not crc[-1] == "\n":
+        crcval = zlib.crc32("")
+        data = ""
+        while 1:
+            newdata = fd.read(262144)
+            if not newdata:
+                break
+            data += newdata
+            # Keep back the last line, it could be the crc line at the end.
+            i = data.rfind("\n", 0, -1) + 1
+            if i == 0:
+                continue
+            lines = data[:i]
+            data = data[i:]
+            crcval = zlib.crc32(lines, crcval)
+            lines = lines.split("\n")
+            lines.pop() # empty string after the last newline
+            for l in lines:
+                entry = l.split(",")
+                if len(entry) < 10:
+                    #print "csv: not enough entries"
+                    return None
+                csv.append(RpmInfo(entry))
+        # The last line holds the crc of all data before it.
+        if not data.startswith("# crc: ") or not data[-1] == "\n":
             #print "crc not correct"
             return None
-        crc = int(crc[7:-1])
-        crcval = zlib.crc32("")
-        for l in lines:
-            crcval = zlib.crc32(l, crcval)
-            if l[-1:] == "\n":
-                l = l[:-1]
-            entry = l.split(",")
-            if len(entry) < 10:
-                #print "csv: not enough entries"
-                return None
-            csv.append(RpmInfo(entry))
-        if crcval != crc:
+        if crcval != int(data[7:-1]):
             #print "csv: crc did not match"
             return None
         return csv
@@ -4173,28 +4408,20 @@ class RpmCSV:
         self.pkglist.append(RpmInfo(pkg))
 
     def writeCSV(self, filename, check=1):
-        # python-only
-        csv = [ pkg.getCSV() for pkg in self.pkglist ]
-        # python-only-end
-        # pyrex-code
-        #csv = []
-        #for pkg in self.pkglist:
-        #    csv.append(pkg.getCSV())
-        # pyrex-code-end
-        # Check if any value contains a wrong character.
-        if check:
-            for l in csv:
-                for item in l:
-                    if "," in item:
-                        return None
+        # Build the complete file in memory, it is written with one call.
+        data = []
+        for pkg in self.pkglist:
+            l = pkg.getCSV()
+            line = ",".join(l)
+            # Check if any value contains a wrong character.
+            if check and line.count(",") != len(l) - 1:
+                return None
+            data.append(line)
+        data.append("")
+        data = "\n".join(data)
         # Write new CSV file with crc checksum.
         (fd, tmp) = mkstemp_file(pathdirname(filename))
-        crcval = zlib.crc32("")
-        for l in csv:
-            data = ",".join(l) + "\n"
-            crcval = zlib.crc32(data, crcval)
-            os.write(fd, data)
-        os.write(fd, "# crc: " + str(crcval) + "\n")
+        os.write(fd, data + "# crc: " + str(zlib.crc32(data)) + "\n")
         os.close(fd)
         os.rename(tmp, filename)
         return 1
@@ -4215,8 +4442,10 @@ def checkCSV():
 
 
 def cacheLocal(urls, filename, subdir, verbose, checksum=None,
-    checksumtype=None, nofilename=0):
+    checksumtype=None, nofilename=0, options=None):
     import urlgrabber
+    if options == None:
+        options = urloptions
     try:
         from M2Crypto.SSL.Checker import WrongHost
     except ImportError:
@@ -4242,11 +4471,11 @@ def cacheLocal(urls, filename, subdir, verbose, checksum=None,
             print "cacheLocal: localfile:", localfile
         try:
             f = urlgrabber.urlgrab(url, localfile,
-                timeout=float(urloptions["timeout"]),
-                retry=int(urloptions["retries"]),
-                keepalive=int(urloptions["keepalive"]),
-                proxies=urloptions["proxies"],
-                http_headers=urloptions["http_headers"])
+                timeout=float(options["timeout"]),
+                retry=int(options["retries"]),
+                keepalive=int(options["keepalive"]),
+                proxies=options["proxies"],
+                http_headers=options["http_headers"])
         except (urlgrabber.grabber.URLGrabError, WrongHost), e:
             if verbose > 4:
                 print "cacheLocal: error: e:", e
@@ -4265,70 +4494,95 @@ def cacheLocal(urls, filename, subdir, verbose, checksum=None,
         return f
     return None
 
+def readUrl(url, verbose):
+    """Return the content of a local file or http/ftp url or None. Unlike
+    cacheLocal() no copy is written into the cache dir."""
+    url = Uri2Filename(url).rstrip("/")
+    if not url.startswith("http://") and not url.startswith("ftp://"):
+        try:
+            return open(url, "r").read()
+        except IOError:
+            return None
+    import urlgrabber
+    try:
+        from M2Crypto.SSL.Checker import WrongHost
+    except ImportError:
+        WrongHost = None
+    try:
+        return urlgrabber.urlread(url, timeout=float(urloptions["timeout"]),
+            retry=int(urloptions["retries"]),
+            keepalive=int(urloptions["keepalive"]),
+            proxies=urloptions["proxies"],
+            http_headers=urloptions["http_headers"])
+    except (urlgrabber.grabber.URLGrabError, WrongHost), e:
+        if verbose > 4:
+            print "readUrl: error: e:", e
+    return None
+
 def buildPkgRefDict(pkgs):
     """Take a list of packages and return a dict that contains all the possible
        naming conventions for them: name, name.arch, name-version-release.arch,
        name-version, name-version-release, epoch:name-version-release."""
     pkgdict = {}
+    setdefault = pkgdict.setdefault
     for pkg in pkgs:
         (n, e, v, r, a) = (pkg["name"], pkg.getEpoch(), pkg["version"],
             pkg["release"], pkg.getArch())
-        na = "%s.%s" % (n, a)
-        nv = "%s-%s" % (n, v)
-        nvr = "%s-%s" % (nv, r)
-        nvra = "%s.%s" % (nvr, a)
-        envra = "%s:%s" % (e, nvra)
-        for item in (n, na, nv, nvr, nvra, envra):
-            pkgdict.setdefault(item, []).append(pkg)
+        nv = n + "-" + v
+        nvr = nv + "-" + r
+        nvra = nvr + "." + a
+        for item in (n, n + "." + a, nv, nvr, nvra, e + ":" + nvra):
+            setdefault(item, []).append(pkg)
     return pkgdict
 
-__fnmatchre__ = re.compile(".*[\*\[\]\{\}\?].*")
+__fnmatchre__ = re.compile("[\*\[\]\{\}\?]")
 def parsePackages(pkgs, requests):
     """Matches up the user request versus a pkg list. For installs/updates
        available pkgs should be the 'others list' for removes it should be
        the installed list of pkgs."""
     matched = []
     if requests:
+        import fnmatch
         pkgdict = buildPkgRefDict(pkgs)
+        # Match all wildcard requests with one combined regex against all
+        # names first, then each single request only needs to be checked
+        # against this (usually short) list of candidates.
+        globs = []
+        for request in requests:
+            if request not in pkgdict and __fnmatchre__.search(request):
+                globs.append("(?:%s)" % fnmatch.translate(request))
+        if globs:
+            regex = re.compile("|".join(globs))
+            candidates = []
+            for item in pkgdict.iterkeys():
+                if regex.match(item):
+                    candidates.append(item)
         for request in requests:
             if request in pkgdict:
                 matched.extend(pkgdict[request])
-            elif __fnmatchre__.match(request):
-                import fnmatch
+            elif __fnmatchre__.search(request):
                 regex = re.compile(fnmatch.translate(request))
-                for item in pkgdict.iterkeys():
+                for item in candidates:
                     if regex.match(item):
                         matched.extend(pkgdict[item])
     return matched
 
-def escape(s):
-    """Return escaped string converted to UTF-8. Return None if the string is
-       empty, so the newChild method does not add text node."""
-    if not s:
-        return None
-    s = s.replace("&", "&amp;")
-    if isinstance(s, unicode):
-        return s
-    try:
-        x = unicode(s, "ascii")
-        return s
-    except UnicodeError:
-        encodings = ("utf-8", "iso-8859-1", "iso-8859-15", "iso-8859-2")
-        for enc in encodings:
-            try:
-                x = unicode(s, enc)
-            except UnicodeError:
-                pass
-            else:
-                if x.encode(enc) == s:
-                    return x.encode("utf-8")
-    newstring = ""
-    for char in s:
-        if ord(char) > 127:
-            newstring = newstring + "?"
+# translate table mapping all non-ascii chars to "?"
+asciitable = "".join(map(chr, xrange(128))) + "?" * 128
+nonasciirc = re.compile("[\x80-\xff]")
+
+def convertUtf8(s):
+    """Return the non-ascii string s converted to UTF-8 or None if none of
+       the commonly used encodings matches."""
+    for enc in ("utf-8", "iso-8859-1", "iso-8859-15", "iso-8859-2"):
+        try:
+            x = unicode(s, enc)
+        except UnicodeError:
+            pass
         else:
-            newstring = newstring + char
-    return re.sub("\n$", "", newstring)
+            if x.encode(enc) == s:
+                return x.encode("utf-8")
+    return None
 
 flagmap = {
     None: None,
@@ -4344,35 +4598,41 @@ flagmap = {
     RPMSENSE_EQUAL | RPMSENSE_LESS: "LE",
     RPMSENSE_EQUAL | RPMSENSE_GREATER: "GE"
 }
-# Files included in primary.xml.
-filerc = re.compile("^(.*bin/.*|/etc/.*|/usr/lib/sendmail)$")
-dirrc = re.compile("^(.*bin/.*|/etc/.*)$")
+# Files included in primary.xml, directories only if the "dir" group matches.
+primaryrc = re.compile("^(?:(?P<dir>.*bin/.*|/etc/.*)|/usr/lib/sendmail)$")
+
+# XML special chars that need to be escaped
+xmlspecialrc = re.compile("[&<>\"]")
+
+def xmlEscape(s):
+    """Return s converted to UTF-8 and with all XML special chars escaped,
+       so it can be written out as element text or attribute value."""
+    s = utf8String(s)
+    if isinstance(s, unicode):
+        s = s.encode("utf-8")
+    # Most strings (e.g. filenames) contain no special chars at all.
+    if not xmlspecialrc.search(s):
+        return s
+    return s.replace("&", "&amp;").replace("<", "&lt;").replace(">",
+        "&gt;").replace("\"", "&quot;")
+
+def xmlElement(indent, name, text):
+    """Return a XML element with name and (unescaped) text content."""
+    text = xmlEscape(text)
+    if not text:
+        return "%s<%s/>" % (indent, name)
+    return "%s<%s>%s</%s>" % (indent, name, text, name)
 
 def utf8String(string):
     """hands back a unicoded string"""
     if string == None:
         return ""
-    if isinstance(string, unicode):
-        return string
-    try:
-        x = unicode(string, "ascii")
+    if isinstance(string, unicode) or not nonasciirc.search(string):
         return string
-    except UnicodeError:
-        for enc in ("utf-8", "iso-8859-1", "iso-8859-15", "iso-8859-2"):
-            try:
-                x = unicode(string, enc)
-            except UnicodeError:
-                pass
-            else:
-                if x.encode(enc) == string:
-                    return x.encode("utf-8")
-    newstring = ""
-    for char in string:
-        if ord(char) > 127:
-            newstring += "?"
-        else:
-            newstring += char
-    return newstring
+    x = convertUtf8(string)
+    if x != None:
+        return x
+    return string.translate(asciitable)
 
 
 def open_fh(filename):
@@ -4467,15 +4727,15 @@ def read_primary(filename, verbose=5):
 
 def testRepo():
     release = "/home/mirror/fedora/development/i386/os"
-    time1 = time.clock()
+    time1 = timer()
     for _ in xrange(1000):
         read_repomd(release + "/repodata/repomd.xml")
-    print time.clock() - time1, "milisec to read one repomd"
+    print timer() - time1, "milisec to read one repomd"
     print read_repomd(release + "/repodata/repomd.xml")
-    time1 = time.clock()
+    time1 = timer()
     for _ in xrange(5):
         read_primary(release + "/repodata/primary.xml.gz")
-    print (time.clock() - time1) / 5.0, "sec to read primary"
+    print (timer() - time1) / 5.0, "sec to read primary"
     print read_primary(release + "/repodata/primary.xml.gz")
 
 
@@ -4488,6 +4748,13 @@ def getProps(reader):
         props[Namef()] = Valuef()
     return props
 
+# ElementTree namespace prefixes of primary.xml
+commonns = "{http://linux.duke.edu/metadata/common}"
+rpmns = "{http://linux.duke.edu/metadata/rpm}"
+# dependency elements within <format> and their rpmtag prefix
+elemdeptags = {rpmns + "provides": "provide", rpmns + "requires": "require",
+    rpmns + "obsoletes": "obsolete", rpmns + "conflicts": "conflict"}
+
 class RpmRepo:
 
     def __init__(self, filenames, excludes, verbose, reponame="default",
@@ -4500,8 +4767,9 @@ class RpmRepo:
         self.reponame = reponame
         self.readsrc = readsrc
         self.filelist_imported = 0
+        self.filelist_cache = None
+        self.urloptions = None # urlgrabber settings from the repo config
         self.checksum = "sha" # "sha" or "md5"
-        self.pretty = 1
         self.pkglist = {}
         self.groupfile = None
         self.fast = fast
@@ -4534,10 +4802,16 @@ class RpmRepo:
                 pchecksumtype)
             if not primary:
                 continue
-            reader = libxml2.newTextReaderFilename(primary)
-            if reader == None:
-                continue
-            self.__parsePrimary(reader)
+            if uselibxml:
+                reader = libxml2.newTextReaderFilename(primary)
+                if reader == None:
+                    continue
+                self.__parsePrimary(reader)
+            else:
+                fh = open_fh(primary)
+                if not fh:
+                    continue
+                self.__iterparsePrimary(fh)
             self.__removeExcluded()
             repogroupfile = self.repomd.get("group", {})
             groupfile = repogroupfile.get("location")
@@ -4554,22 +4828,38 @@ class RpmRepo:
             return 1
         return 0
 
+    def cacheFilelist(self):
+        """Make sure filelists.xml.gz is available locally and return its
+        filename. Nothing is parsed, so this can run for several repos
+        in parallel threads."""
+        if self.filelist_cache == None:
+            repofilelists = self.repomd.get("filelists", {})
+            fchecksum = repofilelists.get("checksum", "no")
+            fchecksumtype = repofilelists.get("checksum_type", "md5")
+            self.filelist_cache = cacheLocal([self.filename],
+                "/repodata/filelists.xml.gz", self.reponame + "/repo",
+                self.verbose, fchecksum, fchecksumtype,
+                options=self.urloptions)
+        return self.filelist_cache
+
     def importFilelist(self):
         if self.filelist_imported:
             return 1
         if self.verbose > 2:
             print "Reading full filelist from %s." % self.filename
-        repofilelists = self.repomd.get("filelists", {})
-        fchecksum = repofilelists.get("checksum", "no")
-        fchecksumtype = repofilelists.get("checksum_type", "md5")
-        filelists = cacheLocal([self.filename], "/repodata/filelists.xml.gz",
-            self.reponame + "/repo", self.verbose, fchecksum, fchecksumtype)
+        filelists = self.cacheFilelist()
         if not filelists:
             return 0
-        reader = libxml2.newTextReaderFilename(filelists)
-        if reader == None:
-            return 0
-        self.__parseFilelist(reader)
+        if uselibxml:
+            reader = libxml2.newTextReaderFilename(filelists)
+            if reader == None:
+                return 0
+            self.__parseFilelist(reader)
+        else:
+            fh = open_fh(filelists)
+            if not fh:
+                return 0
+            self.__iterparseFilelist(fh)
         self.filelist_imported = 1
         return 1
 
@@ -4609,67 +4899,101 @@ class RpmRepo:
         numpkg = len(filenames)
         repodir = filename + "/repodata"
         makeDirs(repodir)
+        # Checksums of the compressed and of the uncompressed data are
+        # computed while writing the files.
         (origpfd, pfdtmp) = mkstemp_file(repodir, special=1)
-        pfd = GzipFile(fileobj=origpfd, mode="wb")
-        if not pfd:
-            return 0
+        origpfd = ChecksumWriter(origpfd, self.checksum)
+        pfd = ChecksumWriter(openGzipWrite(origpfd), self.checksum)
         firstlinexml = "<?xml version=\"1.0\" encoding=\"UTF-8\"?>\n"
         pfd.write(firstlinexml)
         pfd.write("<metadata xmlns=\"http://linux.duke.edu/metadata/common\"" \
             " xmlns:rpm=\"http://linux.duke.edu/metadata/rpm\" " \
             "packages=\"%d\">\n" % numpkg)
         (origffd, ffdtmp) = mkstemp_file(repodir, special=1)
-        ffd = GzipFile(fileobj=origffd, mode="wb")
-        if not ffd:
-            return 0
+        origffd = ChecksumWriter(origffd, self.checksum)
+        ffd = ChecksumWriter(openGzipWrite(origffd), self.checksum)
         ffd.write(firstlinexml)
         ffd.write("<filelists xmlns=\"http://linux.duke.edu/metadata/" \
             "filelists\" packages=\"%d\">\n" % numpkg)
         (origofd, ofdtmp) = mkstemp_file(repodir, special=1)
-        ofd = GzipFile(fileobj=origofd, mode="wb")
-        if not ofd:
-            return 0
+        origofd = ChecksumWriter(origofd, self.checksum)
+        ofd = ChecksumWriter(openGzipWrite(origofd), self.checksum)
         ofd.write(firstlinexml)
         ofd.write("<otherdata xmlns=\"http://linux.duke.edu/metadata/other\"" \
             " packages=\"%s\">\n" % numpkg)
 
-        pdoc = libxml2.newDoc("1.0")
-        proot = pdoc.newChild(None, "metadata", None)
-        basens = proot.newNs("http://linux.duke.edu/metadata/common", None)
-        formatns = proot.newNs("http://linux.duke.edu/metadata/rpm", "rpm")
-        proot.setNs(basens)
-
-        fdoc = libxml2.newDoc("1.0")
-        froot = fdoc.newChild(None, "filelists", None)
-        filesns = froot.newNs("http://linux.duke.edu/metadata/filelists", None)
-        froot.setNs(filesns)
-
-        odoc = libxml2.newDoc("1.0")
-        oroot = odoc.newChild(None, "otherdata", None)
-        otherns = oroot.newNs("http://linux.duke.edu/metadata/other", None)
-        oroot.setNs(otherns)
-
+        # Checksums over the complete rpm files are only computed for
+        # files that changed since the last run, this is tracked with a
+        # cache file within the repodata dir.
+        cachefile = "%s/.pyrpm-checksums.%s" % (repodir, self.checksum)
+        oldcache = readChecksumCache(cachefile)
+        cache = {}
+        todo = []
+        for path in filenames:
+            statkey = getStatKey(path)
+            entry = oldcache.get(path)
+            if entry != None and entry[0] == statkey:
+                cache[path] = entry
+            else:
+                todo.append((path, statkey))
+        # Missing checksums are computed in parallel by worker
+        # processes if python-2.6 multiprocessing is available.
+        try:
+            from multiprocessing import Pool
+        except ImportError:
+            Pool = None
+        pool = checksums = None
+        if Pool != None and len(todo) > 1:
+            pool = Pool()
+            # python-only
+            args = [ (path, self.checksum) for (path, _) in todo ]
+            # python-only-end
+            # pyrex-code
+            #args = []
+            #for (path, _) in todo:
+            #    args.append((path, self.checksum))
+            # pyrex-code-end
+            checksums = pool.imap(getChecksumTuple, args, 16)
+        todo.reverse()
         for path in filenames:
             if self.verbose >= 2:
                 printhash.nextObject()
+            if path in cache:
+                yumchecksum = cache[path][1]
+            else:
+                statkey = todo.pop()[1]
+                if checksums != None:
+                    yumchecksum = checksums.next()
+                else:
+                    yumchecksum = getChecksum(path, self.checksum)
+                if statkey != None and yumchecksum != None:
+                    cache[path] = (statkey, yumchecksum)
             pkg = ReadRpm(path)
             if pkg.readHeader(rpmsigtag, rpmtag):
                 print "Cannot read %s.\n" % path
                 continue
             pkg["yumlocation"] = path[len(filename) + 1:]
-            pkg["yumchecksum"] = getChecksum(pkg.filename, self.checksum)
-            self.__writePrimary(pfd, proot, pkg, formatns)
-            self.__writeFilelists(ffd, froot, pkg)
-            self.__writeOther(ofd, oroot, pkg)
+            pkg["yumchecksum"] = yumchecksum
+            self.__writePrimary(pfd, pkg)
+            self.__writeFilelists(ffd, pkg)
+            self.__writeOther(ofd, pkg)
+        if pool != None:
+            pool.close()
+            pool.join()
+        if cache != oldcache:
+            writeChecksumCache(cachefile, cache)
         pfd.write("</metadata>\n")
         ffd.write("</filelists>\n")
         ofd.write("</otherdata>\n")
-        # python-only
-        del pfd, ffd, ofd
-        # python-only-end
+        pfd.close()
+        ffd.close()
+        ofd.close()
         origpfd.close()
         origffd.close()
         origofd.close()
+        csums = {"primary": (origpfd.hexdigest(), pfd.hexdigest()),
+            "filelists": (origffd.hexdigest(), ffd.hexdigest()),
+            "other": (origofd.hexdigest(), ofd.hexdigest())}
 
         repodoc = libxml2.newDoc("1.0")
         reporoot = repodoc.newChild(None, "repomd", None)
@@ -4682,10 +5006,10 @@ class RpmRepo:
             workfiles.append((ngroupfile, 0, "group"))
         for (ffile, gzfile, ftype) in workfiles:
             if gzfile:
-                zfo = PyGZIP(ffile, None, None, None)
-                uncsum = getChecksum(zfo, self.checksum)
+                (csum, uncsum) = csums[ftype]
+            else:
+                csum = getChecksum(ffile, self.checksum)
             timestamp = os.stat(ffile).st_mtime
-            csum = getChecksum(ffile, self.checksum)
             data = reporoot.newChild(None, "data", None)
             data.newProp("type", ftype)
             location = data.newChild(None, "location", None)
@@ -4777,12 +5101,30 @@ class RpmRepo:
                     if self.readsrc or pkg["arch"] != "src":
                         self.pkglist[pkg.getNEVRA0()] = pkg
 
+    def __iterparsePrimary(self, fh):
+        """Same as __parsePrimary(), but use ElementTree iterparse(), which
+        hands over complete <package> elements with their attributes."""
+        packagetag = commonns + "package"
+        pkglist = self.pkglist
+        for (_, elem) in iterparse(fh):
+            if elem.tag != packagetag:
+                continue
+            if elem.get("type") == "rpm":
+                pkg = self.__parsePackageElem(elem)
+                if self.readsrc or pkg["arch"] != "src":
+                    pkglist[pkg.getNEVRA0()] = pkg
+            elem.clear()
+
     def delDebuginfo(self):
+        # Build a new hash instead of deleting entries while iterating.
+        pkglist = {}
         for (nevra, pkg) in self.pkglist.iteritems():
             # or should we search for "-debuginfo" only?
-            if (pkg["name"].endswith("-debuginfo") or
-                pkg["name"] == "glibc-debuginfo-common"):
-                del self.pkglist[nevra]
+            name = pkg["name"]
+            if (not name.endswith("-debuginfo") and
+                name != "glibc-debuginfo-common"):
+                pkglist[nevra] = pkg
+        self.pkglist = pkglist
 
     def __removeExcluded(self):
         for pkg in parsePackages(self.pkglist.values(), self.excludes):
@@ -4793,80 +5135,72 @@ class RpmRepo:
     def __isExcluded(self, pkg):
         return len(parsePackages([pkg, ], self.excludes)) != 0
 
-    def __writeVersion(self, pkg_node, pkg):
-        tnode = pkg_node.newChild(None, "version", None)
-        tnode.newProp("epoch", pkg.getEpoch())
-        tnode.newProp("ver", pkg["version"])
-        tnode.newProp("rel", pkg["release"])
-
-    def __writePrimary(self, fd, parent, pkg, formatns):
-        pkg_node = parent.newChild(None, "package", None)
-        pkg_node.newProp("type", "rpm")
-        pkg_node.newChild(None, "name", pkg["name"])
-        pkg_node.newChild(None, "arch", pkg.getArch())
-        self.__writeVersion(pkg_node, pkg)
-        tnode = pkg_node.newChild(None, "checksum", pkg["yumchecksum"])
-        tnode.newProp("type", self.checksum)
-        tnode.newProp("pkgid", "YES")
-        pkg_node.newChild(None, "summary", escape(pkg["summary"][0]))
-        pkg_node.newChild(None, "description", escape(pkg["description"][0]))
-        pkg_node.newChild(None, "packager", escape(pkg["packager"]))
-        pkg_node.newChild(None, "url", escape(pkg["url"]))
-        tnode = pkg_node.newChild(None, "time", None)
+    # The package entries of primary.xml, filelists.xml and other.xml
+    # are written out directly as (pretty printed) text instead of building
+    # and serializing a libxml2 tree for each package.
+
+    def __writeVersion(self, out, indent, pkg):
+        out.append("%s<version epoch=\"%s\" ver=\"%s\" rel=\"%s\"/>" % \
+            (indent, pkg.getEpoch(), xmlEscape(pkg["version"]),
+            xmlEscape(pkg["release"])))
+
+    def __writePrimary(self, fd, pkg):
+        out = ["<package type=\"rpm\">",
+            xmlElement("  ", "name", pkg["name"]),
+            xmlElement("  ", "arch", pkg.getArch())]
+        self.__writeVersion(out, "  ", pkg)
+        out.append("  <checksum type=\"%s\" pkgid=\"YES\">%s</checksum>" % \
+            (self.checksum, pkg["yumchecksum"]))
+        out.append(xmlElement("  ", "summary", pkg["summary"][0]))
+        out.append(xmlElement("  ", "description", pkg["description"][0]))
+        out.append(xmlElement("  ", "packager", pkg["packager"]))
+        out.append(xmlElement("  ", "url", pkg["url"]))
         st = os.stat(pkg.filename)
-        tnode.newProp("file", str(st.st_mtime))
-        tnode.newProp("build", str(pkg["buildtime"][0]))
-        tnode = pkg_node.newChild(None, "size", None)
-        # st.st_size == 96 + pkg.sigdatasize + pkg.sig.getOne("size_in_sig")
-        tnode.newProp("package", str(st.st_size))
-        tnode.newProp("installed", str(pkg["size"][0]))
+        out.append("  <time file=\"%s\" build=\"%s\"/>" % (st.st_mtime,
+            pkg["buildtime"][0]))
         archivesize = pkg.hdr.getOne("archivesize")
         if archivesize == None:
             archivesize = pkg.sig.getOne("payloadsize")
-        tnode.newProp("archive", str(archivesize))
-        tnode = pkg_node.newChild(None, "location", None)
-        tnode.newProp("href", pkg["yumlocation"])
-        fnode = pkg_node.newChild(None, "format", None)
-        self.__generateFormat(fnode, pkg, formatns)
-        output = pkg_node.serialize("UTF-8", self.pretty)
-        fd.write(output + "\n")
-        pkg_node.unlinkNode()
-        pkg_node.freeNode()
-
-    def __writePkgInfo(self, parent, pkg):
-        pkg_node = parent.newChild(None, "package", None)
-        pkg_node.newProp("pkgid", pkg["yumchecksum"])
-        pkg_node.newProp("name", pkg["name"])
-        pkg_node.newProp("arch", pkg.getArch())
-        self.__writeVersion(pkg_node, pkg)
-        return pkg_node
-
-    def __writeFilelists(self, fd, parent, pkg):
-        pkg_node = self.__writePkgInfo(parent, pkg)
-        self.__generateFilelist(pkg_node, pkg, 0)
-        output = pkg_node.serialize("UTF-8", self.pretty)
-        fd.write(output + "\n")
-        pkg_node.unlinkNode()
-        pkg_node.freeNode()
-
-    def __writeOther(self, fd, parent, pkg):
-        pkg_node = self.__writePkgInfo(parent, pkg)
+        # st.st_size == 96 + pkg.sigdatasize + pkg.sig.getOne("size_in_sig")
+        out.append("  <size package=\"%s\" installed=\"%s\" " \
+            "archive=\"%s\"/>" % (st.st_size, pkg["size"][0], archivesize))
+        out.append("  <location href=\"%s\"/>" % \
+            xmlEscape(pkg["yumlocation"]))
+        out.append("  <format>")
+        self.__generateFormat(out, pkg)
+        out.append("  </format>")
+        out.append("</package>\n")
+        fd.write("\n".join(out))
+
+    def __writePkgInfo(self, out, pkg):
+        out.append("<package pkgid=\"%s\" name=\"%s\" arch=\"%s\">" % \
+            (pkg["yumchecksum"], xmlEscape(pkg["name"]),
+            xmlEscape(pkg.getArch())))
+        self.__writeVersion(out, "  ", pkg)
+
+    def __writeFilelists(self, fd, pkg):
+        out = []
+        self.__writePkgInfo(out, pkg)
+        self.__generateFilelist(out, "  ", pkg, 0)
+        out.append("</package>\n")
+        fd.write("\n".join(out))
+
+    def __writeOther(self, fd, pkg):
+        out = []
+        self.__writePkgInfo(out, pkg)
         if pkg["changelogname"] != None:
             for (name, ctime, text) in zip(pkg["changelogname"],
                 pkg["changelogtime"], pkg["changelogtext"]):
-                clog = pkg_node.newChild(None, "changelog", None)
-                clog.addContent(utf8String(text))
-                clog.newProp("author", utf8String(name))
-                clog.newProp("date", str(ctime))
-        output = pkg_node.serialize("UTF-8", self.pretty)
-        fd.write(output + "\n")
-        pkg_node.unlinkNode()
-        pkg_node.freeNode()
+                out.append("  <changelog author=\"%s\" date=\"%s\">%s" \
+                    "</changelog>" % (xmlEscape(name), ctime, xmlEscape(text)))
+        out.append("</package>\n")
+        fd.write("\n".join(out))
 
     def __parsePackage(self, reader):
         Readf = reader.Read
         NodeTypef = reader.NodeType
         Namef = reader.Name
+        Valuef = reader.Value
         pkg = ReadRpm("repopkg")
         pkg.sig = HdrIndex()
         pkg.hdr = HdrIndex()
@@ -4883,11 +5217,12 @@ class RpmRepo:
             name = Namef()
             if name == "name":
                 Readf()
-                pkg["name"] = reader.Value()
+                pkg["name"] = Valuef()
             elif name == "arch":
                 Readf()
-                pkg["arch"] = reader.Value()
-                if pkg["arch"] == "src":
+                arch = Valuef()
+                pkg["arch"] = arch
+                if arch == "src":
                     pkg.issrc = 1
                 else:
                     pkg["sourcerpm"] = ""
@@ -4906,10 +5241,10 @@ class RpmRepo:
                     props = getProps(reader)
                     if props["type"] == "md5":
                         Readf()
-                        pkg.sig["md5"] = reader.Value()
+                        pkg.sig["md5"] = Valuef()
                     elif props["type"] == "sha":
                         Readf()
-                        pkg.sig["sha1header"] = reader.Value()
+                        pkg.sig["sha1header"] = Valuef()
                     elif self.verbose > 4:
                         print "unknown checksum type"
                 elif name == "size":
@@ -4920,13 +5255,56 @@ class RpmRepo:
                     print "new package entry: %s" % name
         return pkg
 
+    def __parsePackageElem(self, elem):
+        """Same as __parsePackage(), but for an ElementTree element."""
+        pkg = ReadRpm("repopkg")
+        pkg.sig = HdrIndex()
+        pkg.hdr = HdrIndex()
+        pkg.setHdr()
+        pkg.sig["size_in_sig"] = [0, ]
+        for node in elem:
+            name = node.tag
+            if name == commonns + "name":
+                pkg["name"] = node.text
+            elif name == commonns + "arch":
+                arch = node.text
+                pkg["arch"] = arch
+                if arch == "src":
+                    pkg.issrc = 1
+                else:
+                    pkg["sourcerpm"] = ""
+            elif name == commonns + "version":
+                props = node.attrib
+                pkg["version"] = props["ver"]
+                pkg["release"] = props["rel"]
+                pkg["epoch"] = [int(props["epoch"]), ]
+            elif name == commonns + "location":
+                pkg.filename = self.filename + "/" + node.get("href")
+            elif name == commonns + "format":
+                self.__parseFormatElem(node, pkg)
+            elif self.fast == 0:
+                if name == commonns + "checksum":
+                    ctype = node.get("type")
+                    if ctype == "md5":
+                        pkg.sig["md5"] = node.text
+                    elif ctype == "sha":
+                        pkg.sig["sha1header"] = node.text
+                    elif self.verbose > 4:
+                        print "unknown checksum type"
+                elif name == commonns + "size":
+                    pkg.sig["size_in_sig"][0] += int(node.get("package", "0"))
+                elif self.verbose > 4 and _bn(name) not in ("summary",
+                    "description", "packager", "url", "time"):
+                    print "new package entry: %s" % _bn(name)
+        return pkg
+
     def __parseFilelist(self, reader):
         # Make local variables for heavy used functions to speed up this loop.
         Readf = reader.Read
         NodeTypef = reader.NodeType
         Namef = reader.Name
         Valuef = reader.Value
-        filelist = []
+        pkglist = self.pkglist
         while Readf() == 1:
             if NodeTypef() != TYPE_ELEMENT or Namef() != "package":
                 continue
@@ -4934,13 +5312,15 @@ class RpmRepo:
             pname = props.get("name", "no-name")
             arch = props.get("arch", "no-arch")
             (epoch, version, release) = ("", "", "")
+            filelist = []
+            append = filelist.append
             while Readf() == 1:
                 ntype = NodeTypef()
                 if ntype == TYPE_ELEMENT:
                     name = Namef()
                     if name == "file":
                         Readf()
-                        filelist.append(Valuef())
+                        append(Valuef())
                     elif name == "version":
                         props = getProps(reader)
                         epoch   = props["epoch"]
@@ -4952,85 +5332,117 @@ class RpmRepo:
                     if Namef() == "package":
                         break
                     continue
-        nevra = "%s-%s:%s-%s.%s" % (pname, epoch, version, release, arch)
-        if nevra in self.pkglist:
-            pkg = self.pkglist[nevra]
-            pkg["oldfilenames"] = filelist
-            #(pkg["basenames"], pkg["dirindexes"], pkg["dirnames"]) = \
-            #    genBasenames(filelist)
-
-    def __generateFormat(self, node, pkg, formatns):
-        node.newChild(formatns, "license", escape(pkg["license"]))
-        node.newChild(formatns, "vendor", escape(pkg["vendor"]))
-        node.newChild(formatns, "group", escape(pkg["group"][0]))
-        node.newChild(formatns, "buildhost", escape(pkg["buildhost"]))
-        node.newChild(formatns, "sourcerpm", escape(pkg["sourcerpm"]))
-        tnode = node.newChild(formatns, "header-range", None)
+            nevra = "%s-%s:%s-%s.%s" % (pname, epoch, version, release, arch)
+            if nevra in pkglist:
+                pkg = pkglist[nevra]
+                pkg["oldfilenames"] = filelist
+                #(pkg["basenames"], pkg["dirindexes"], pkg["dirnames"]) = \
+                #    genBasenames(filelist)
+
+    def __generateFormat(self, out, pkg):
+        out.append(xmlElement("    ", "rpm:license", pkg["license"]))
+        out.append(xmlElement("    ", "rpm:vendor", pkg["vendor"]))
+        out.append(xmlElement("    ", "rpm:group", pkg["group"][0]))
+        out.append(xmlElement("    ", "rpm:buildhost", pkg["buildhost"]))
+        out.append(xmlElement("    ", "rpm:sourcerpm", pkg["sourcerpm"]))
         start = 96 + pkg.sigdatasize
         end = start + pkg.hdrdatasize
-        tnode.newProp("start", str(start))
-        tnode.newProp("end", str(end))
+        out.append("    <rpm:header-range start=\"%d\" end=\"%d\"/>" % \
+            (start, end))
         provides = pkg.getProvides()
         if len(provides) > 0:
-            self.__generateDeps(node, "provides", provides, formatns)
+            self.__generateDeps(out, "provides", provides)
         conflicts = pkg.getConflicts()
         if len(conflicts) > 0:
-            self.__generateDeps(node, "conflicts", conflicts, formatns)
+            self.__generateDeps(out, "conflicts", conflicts)
         obsoletes = pkg.getObsoletes()
         if len(obsoletes) > 0:
-            self.__generateDeps(node, "obsoletes", obsoletes, formatns)
+            self.__generateDeps(out, "obsoletes", obsoletes)
         requires = pkg.getRequires()
         if len(requires) > 0:
-            self.__generateDeps(node, "requires", requires, formatns)
-        self.__generateFilelist(node, pkg)
+            self.__generateDeps(out, "requires", requires)
+        self.__generateFilelist(out, "    ", pkg)
 
-    def __generateDeps(self, node, name, deps, formatns):
-        dnode = node.newChild(formatns, name, None)
+    def __generateDeps(self, out, name, deps):
+        out.append("    <rpm:%s>" % name)
         deps = self.__filterDuplicateDeps(deps)
-        for dep in deps:
-            enode = dnode.newChild(formatns, "entry", None)
-            enode.newProp("name", dep[0])
-            if dep[1] != "":
-                if (dep[1] & RPMSENSE_SENSEMASK) != 0:
-                    enode.newProp("flags", flagmap[dep[1] & RPMSENSE_SENSEMASK])
-            if dep[2] != "":
-                (e, v, r) = evrSplit(dep[2])
-                enode.newProp("epoch", e)
-                enode.newProp("ver", v)
+        for (dname, flags, version) in deps:
+            entry = "      <rpm:entry name=\"%s\"" % xmlEscape(dname)
+            if (flags & RPMSENSE_SENSEMASK) != 0:
+                entry += " flags=\"%s\"" % flagmap[flags & RPMSENSE_SENSEMASK]
+            if version != "":
+                (e, v, r) = evrSplit(version)
+                entry += " epoch=\"%s\" ver=\"%s\"" % (e, xmlEscape(v))
                 if r != "":
-                    enode.newProp("rel", r)
-            if dep[1] != "" and name == "requires":
-                #if isLegacyPreReq(dep[1]) or isInstallPreReq(dep[1]):
-                if (dep[1] & RPMSENSE_PREREQ) != 0:
-                    enode.newProp("pre", "1")
-
-    def __generateFilelist(self, node, pkg, filter2=1):
+                    entry += " rel=\"%s\"" % xmlEscape(r)
+            if name == "requires":
+                #if isLegacyPreReq(flags) or isInstallPreReq(flags):
+                if (flags & RPMSENSE_PREREQ) != 0:
+                    entry += " pre=\"1\""
+            out.append(entry + "/>")
+        out.append("    </rpm:%s>" % name)
+
+    def __generateFilelist(self, out, indent, pkg, filter2=1):
         files = pkg.getFilenames()
         fileflags = pkg["fileflags"]
         filemodes = pkg["filemodes"]
         if files == None or fileflags == None or filemodes == None:
             return
         (writefile, writedir, writeghost) = ([], [], [])
+        # Make local variables for heavy used functions to speed up this loop.
+        (filea, dira, ghosta) = (writefile.append, writedir.append,
+            writeghost.append)
+        match = primaryrc.match
         for (fname, mode, flag) in zip(files, filemodes, fileflags):
-            if S_ISDIR(mode):
-                if not filter2 or dirrc.match(fname):
-                    writedir.append(fname)
-            elif not filter2 or filerc.match(fname):
-                if flag & RPMFILE_GHOST:
-                    writeghost.append(fname)
-                else:
-                    writefile.append(fname)
-        writefile.sort()
-        for f in writefile:
-            tnode = node.newChild(None, "file", escape(f))
-        writedir.sort()
-        for f in writedir:
-            tnode = node.newChild(None, "file", escape(f))
-            tnode.newProp("type", "dir")
-        writeghost.sort()
-        for f in writeghost:
-            tnode = node.newChild(None, "file", escape(f))
-            tnode.newProp("type", "ghost")
+            isdir = S_ISDIR(mode)
+            if filter2:
+                m = match(fname)
+                if m == None or (isdir and m.lastgroup != "dir"):
+                    continue
+            if isdir:
+                dira(fname)
+            elif flag & RPMFILE_GHOST:
+                ghosta(fname)
+            else:
+                filea(fname)
+        outa = out.append
+        for (flist, ftype) in ((writefile, ""), (writedir, " type=\"dir\""),
+            (writeghost, " type=\"ghost\"")):
+            flist.sort()
+            start = "%s<file%s>" % (indent, ftype)
+            for f in flist:
+                outa(start + xmlEscape(f) + "</file>")
+
+    def __iterparseFilelist(self, fh):
+        """Same as __parseFilelist(), but use ElementTree iterparse(), which
+        hands over complete <package> elements with their attributes."""
+        ns = "{http://linux.duke.edu/metadata/filelists}"
+        (packagetag, filetag, versiontag) = (ns + "package", ns + "file",
+            ns + "version")
+        pkglist = self.pkglist
+        for (_, elem) in iterparse(fh):
+            if elem.tag != packagetag:
+                continue
+            (epoch, version, release) = ("", "", "")
+            filelist = []
+            append = filelist.append
+            for child in elem:
+                tag = child.tag
+                if tag == filetag:
+                    append(child.text)
+                elif tag == versiontag:
+                    props = child.attrib
+                    epoch   = props["epoch"]
+                    version = props["ver"]
+                    release = props["rel"]
+                elif self.verbose > 4:
+                    print "new filelist: %s" % _bn(tag)
+            props = elem.attrib
+            nevra = "%s-%s:%s-%s.%s" % (props.get("name", "no-name"), epoch,
+                version, release, props.get("arch", "no-arch"))
+            elem.clear()
+            if nevra in pkglist:
+                pkglist[nevra]["oldfilenames"] = filelist
 
     def __parseFormat(self, reader, pkg):
         filelist = []
@@ -5075,12 +5487,37 @@ class RpmRepo:
         #(pkg["basenames"], pkg["dirindexes"], pkg["dirnames"]) = \
         #    genBasenames(filelist)
 
+    def __parseFormatElem(self, elem, pkg):
+        """Same as __parseFormat(), but for an ElementTree element."""
+        filelist = []
+        for node in elem:
+            name = node.tag
+            if name == rpmns + "header-range":
+                props = node.attrib
+                header_start = int(props.get("start", "0"))
+                header_end = int(props.get("end", "0"))
+                pkg.sig["size_in_sig"][0] -= header_start
+                pkg["rpm:header-range:end"] = header_end
+            elif self.fast == 0:
+                if name == rpmns + "sourcerpm":
+                    pkg["sourcerpm"] = node.text
+                elif name in elemdeptags:
+                    tag = elemdeptags[name]
+                    (pkg[tag + "name"], pkg[tag + "flags"],
+                        pkg[tag + "version"]) = self.__parseDepsElem(node)
+                elif name == commonns + "file":
+                    filelist.append(node.text)
+                elif self.verbose > 4 and _bn(name) not in ("vendor",
+                    "buildhost", "group", "license"):
+                    print "new repo entry: %s" % _bn(name)
+        pkg["oldfilenames"] = filelist
+
     def __filterDuplicateDeps(self, deps):
-        fdeps = []
+        mask = RPMSENSE_SENSEMASK | RPMSENSE_PREREQ
+        fdeps = {}
         for (name, flags, version) in deps:
-            flags &= RPMSENSE_SENSEMASK | RPMSENSE_PREREQ
-            if (name, flags, version) not in fdeps:
-                fdeps.append((name, flags, version))
+            fdeps[(name, flags & mask, version)] = None
+        fdeps = fdeps.keys()
         fdeps.sort()
         return fdeps
 
@@ -5088,7 +5525,12 @@ class RpmRepo:
         Readf = reader.Read
         NodeTypef = reader.NodeType
         Namef = reader.Name
-        plist = ([], [], [])
+        # The flags are stored as compact C ints, not as python int objects.
+        plist = ([], array("i"), [])
+        (nameappend, flagsappend, versionappend) = (plist[0].append,
+            plist[1].append, plist[2].append)
+        flagmapf = flagmap.__getitem__
+        GetAttributef = reader.GetAttribute
         while Readf() == 1:
             ntype = NodeTypef()
             if ntype == TYPE_END_ELEMENT:
@@ -5098,21 +5540,49 @@ class RpmRepo:
             if ntype != TYPE_ELEMENT:
                 continue
             if Namef() == "rpm:entry":
-                props = getProps(reader)
-                name  = props["name"]
-                flags = flagmap[props.get("flags", "")]
-                if "pre" in props:
+                # Only read the needed attributes instead of building a
+                # dict of all of them with getProps().
+                flags = flagmapf(GetAttributef("flags") or "")
+                if GetAttributef("pre") != None:
                     flags |= RPMSENSE_PREREQ
-                epoch = ""
-                if "epoch" in props:
-                    epoch = props["epoch"] + ":"
-                ver = props.get("ver", "")
-                rel = ""
-                if "rel" in props:
-                    rel = "-" + props["rel"]
-                plist[0].append(name)
-                plist[1].append(flags)
-                plist[2].append("%s%s%s" % (epoch, ver, rel))
+                version = GetAttributef("ver") or ""
+                epoch = GetAttributef("epoch")
+                if epoch != None:
+                    version = epoch + ":" + version
+                rel = GetAttributef("rel")
+                if rel != None:
+                    version += "-" + rel
+                nameappend(GetAttributef("name"))
+                flagsappend(flags)
+                versionappend(version)
+        return plist
+
+    def __parseDepsElem(self, elem):
+        """Same as __parseDeps(), but for an ElementTree element."""
+        # The flags are stored as compact C ints, not as python int objects.
+        plist = ([], array("i"), [])
+        (nameappend, flagsappend, versionappend) = (plist[0].append,
+            plist[1].append, plist[2].append)
+        flagmapf = flagmap.__getitem__
+        entrytag = rpmns + "entry"
+        for node in elem:
+            if node.tag != entrytag:
+                continue
+            props = node.attrib
+            get = props.get
+            flags = flagmapf(get("flags", ""))
+            if "pre" in props:
+                flags |= RPMSENSE_PREREQ
+            version = get("ver", "")
+            epoch = get("epoch")
+            if epoch != None:
+                version = epoch + ":" + version
+            rel = get("rel")
+            if rel != None:
+                version += "-" + rel
+            nameappend(props["name"])
+            flagsappend(flags)
+            versionappend(version)
         return plist
 
 
@@ -5122,12 +5592,17 @@ def parseBoolean(s):
         return 1
     return 0
 
+# ElementTree name of the xml:lang attribute
+xmllang = "{http://www.w3.org/XML/1998/namespace}lang"
+
 class RpmCompsXML:
 
     def __init__(self, filename):
         self.filename = filename
         self.grouphash = {}
         self.grouphierarchyhash = {}
+        # (group, typelist) -> sorted list of (pkgname, requires)
+        self.pkgnamescache = {}
 
     def printErr(self, err):
         print "%s: %s" % (self.filename, err)
@@ -5136,6 +5611,9 @@ class RpmCompsXML:
         return str(self.grouphash)
 
     def read(self, filename):
+        self.pkgnamescache = {}
+        if not uselibxml:
+            return self.__iterparse(filename)
         doc = libxml2.parseFile(filename)
         if doc == None:
             return 0
@@ -5161,7 +5639,31 @@ class RpmCompsXML:
                 self.printErr("Unknown entry in comps.xml: %s" % node.name)
                 return 0
             node = node.next
-        return 0
+        return 1
+
+    def __iterparse(self, filename):
+        """Same as read(), but use ElementTree iterparse() and only keep
+        one group in memory at a time."""
+        depth = 0
+        try:
+            for (event, elem) in iterparse(filename, ("start", "end")):
+                if event == "start":
+                    depth += 1
+                    continue
+                depth -= 1
+                if depth != 1:
+                    continue
+                if elem.tag == "group" or elem.tag == "category":
+                    self.__parseGroupElem(elem)
+                # We don't need grouphierarchies, so don't parse them ;)
+                elif elem.tag != "grouphierarchy":
+                    self.printErr("Unknown entry in comps.xml: %s" % elem.tag)
+                    return 0
+                elem.clear()
+        except (IOError, SyntaxError), e:
+            self.printErr(e)
+            return 0
+        return 1
 
     def getPackageNames(self, group):
         ret = self.__getPackageNames(group, ("mandatory", "default"))
@@ -5181,27 +5683,38 @@ class RpmCompsXML:
         return self.__getPackageNames(group, ("mandatory",))
 
     def __getPackageNames(self, group, typelist):
+        # Groups are often included from several other groups, so the
+        # result for each group is only computed once.
+        key = (group, typelist)
+        ret = self.pkgnamescache.get(key)
+        if ret != None:
+            return ret[:]
+        # This empty entry also stops the recursion for cyclic groups.
+        self.pkgnamescache[key] = []
         ret = []
-        if not self.grouphash.has_key(group):
+        grp = self.grouphash.get(group)
+        if grp == None:
             return ret
-        if self.grouphash[group].has_key("packagelist"):
-            pkglist = self.grouphash[group]["packagelist"]
-            for pkgname in pkglist:
-                for t in typelist:
-                    if pkglist[pkgname][0] == t:
-                        ret.append((pkgname, pkglist[pkgname][1]))
-        if self.grouphash[group].has_key("grouplist"):
-            grplist = self.grouphash[group]["grouplist"]
+        pkglist = grp.get("packagelist")
+        if pkglist != None:
+            for (pkgname, pkgdata) in pkglist.iteritems():
+                if pkgdata[0] in typelist:
+                    ret.append((pkgname, pkgdata[1]))
+        grplist = grp.get("grouplist")
+        if grplist != None:
             for grpname in grplist["groupreqs"]:
                 ret.extend(self.__getPackageNames(grpname, typelist))
             for grpname in grplist["metapkgs"]:
                 ret.extend(self.__getPackageNames(grpname, typelist))
-        # Sort and duplicate removal
+        # Sort and duplicate removal, the entries hold lists and cannot be
+        # used as dict keys.
         ret.sort()
-        for i in xrange(len(ret) - 2, -1, -1):
-            if ret[i + 1] == ret[i]:
-                ret.pop(i + 1)
-        return ret
+        ret2 = ret[:1]
+        for r in ret[1:]:
+            if r != ret2[-1]:
+                ret2.append(r)
+        self.pkgnamescache[key] = ret2
+        return ret2[:]
 
     def __parseGroup(self, node):
         group = {}
@@ -5235,6 +5748,47 @@ class RpmCompsXML:
         self.grouphash[group["id"]] = group
         return 1
 
+    def __parseGroupElem(self, elem):
+        """Same as __parseGroup(), but for an ElementTree element."""
+        group = {}
+        for node in elem:
+            tag = node.tag
+            content = node.text or ""
+            if tag == "name" or tag == "description":
+                lang = node.get(xmllang) or node.get("lang")
+                if lang:
+                    group[tag + ":" + lang] = content
+                else:
+                    group[tag] = content
+            elif tag == "id":
+                group["id"] = content
+            elif tag == "default":
+                group["default"] = parseBoolean(content)
+            elif tag == "langonly":
+                group["langonly"] = content
+            elif tag == "packagelist":
+                plist = {}
+                for child in node:
+                    if child.tag == "packagereq":
+                        requires = child.get("requires")
+                        if requires != None:
+                            requires = requires.split()
+                        else:
+                            requires = []
+                        plist[child.text or ""] = (child.get("type",
+                            "default"), requires)
+                group["packagelist"] = plist
+            elif tag == "grouplist":
+                glist = {"groupreqs": [], "metapkgs": {}}
+                for child in node:
+                    if child.tag == "groupreq" or child.tag == "groupid":
+                        glist["groupreqs"].append(child.text or "")
+                    elif child.tag == "metapkg":
+                        glist["metapkgs"][child.text or ""] = \
+                            child.get("type", "default")
+                group["grouplist"] = glist
+        self.grouphash[group["id"]] = group
+
     def __parsePackageList(self, node):
         plist = {}
         while node != None:
@@ -5286,11 +5840,14 @@ def getVars(releasever, arch, basearch):
         key = "YUM%d" % i
         value = os.environ.get(key)
         if value != None:
-            replacevars[key.lower()] = value
-            replacevars[key] = value
+            replacevars["$" + key.lower()] = value
+            replacevars["$" + key] = value
     return replacevars
 
 def replaceVars(line, data):
+    # All variables start with "$", most lines do not contain any.
+    if "$" not in line:
+        return line
     for (key, value) in data.iteritems():
         line = line.replace(key, value)
     return line
@@ -5336,30 +5893,35 @@ def YumConf2(filename, verbose, data):
     if os.path.isfile(filename) and os.access(filename, os.R_OK):
         if verbose > 2:
             print "Reading in config file %s." % filename
-        lines = open(filename, "r").readlines()
+        fd = open(filename, "r")
+        lines = fd.read().splitlines()
+        fd.close()
     stanza = "main"
+    varnames = MainVarnames
     prevcommand = None
     for linenum in xrange(len(lines)):
-        line = lines[linenum].rstrip("\n\r")
-        if line[:1] == "[" and line.find("]") != -1:
+        line = lines[linenum]
+        first = line[:1]
+        if first == "[" and line.find("]") != -1:
             stanza = line[1:line.find("]")]
+            if stanza == "main":
+                varnames = MainVarnames
+            else:
+                varnames = RepoVarnames
             prevcommand = None
-        elif prevcommand and line[:1] in " \t":
+        elif prevcommand and first in " \t":
             # continuation line
             line = line.strip()
             if line and line[:1] not in "#;":
                 data[stanza][prevcommand].append(line)
         else:
             line = line.strip()
+            i = line.find("=")
             if line[:1] in "#;" or not line:
                 pass # comment line
-            elif line.find("=") != -1:
-                (key, value) = line.split("=", 1)
-                (key, value) = (key.strip(), value.strip())
-                if stanza == "main":
-                    if key not in MainVarnames:
-                        return linenum + 1 # unknown key value
-                elif key not in RepoVarnames:
+            elif i != -1:
+                (key, value) = (line[:i].strip(), line[i + 1:].strip())
+                if key not in varnames:
                     return linenum + 1 # unknown key value
                 prevcommand = None
                 if key in ("baseurl", "mirrorlist"):
@@ -5383,17 +5945,16 @@ def readYumConf(configfiles, reposdirs, verbose, buildroot, rpmdbpath,
     return (yumconfs, distroverpkg, releasever)
 
 
-def readMirrorlist(mirrorlist, replacevars, key, verbose):
+def readMirrorlist(mirrorlist, replacevars, verbose):
     baseurls = []
     for mlist in mirrorlist:
         mlist = replaceVars(mlist, replacevars)
         if verbose > 2:
             print "Getting mirrorlist from %s." % mlist
-        fname = cacheLocal([mlist], "mirrorlist", key,
-            verbose, nofilename=1)
-        if not fname:
+        data = readUrl(mlist, verbose)
+        if not data:
             continue
-        for l in open(fname).readlines():
+        for l in data.splitlines():
             l = l.strip()
             l = l.replace("$ARCH", "$basearch")
             if l and l[0] != "#":
@@ -5404,6 +5965,7 @@ def readRepos(yumconfs, releasever, arch, readdebug,
     readsrc, verbose, readgroupfile=0, fast=1):
     global urloptions # pylint: disable-msg=W0603
     basearch = buildarchtranslate.get(arch, arch)
+    replacevars = getVars(releasever, arch, basearch)
     repos = []
     for yumconf in yumconfs:
         for key in yumconf.iterkeys():
@@ -5414,7 +5976,6 @@ def readRepos(yumconfs, releasever, arch, readdebug,
                 continue
             urloptions = setOptions(yumconf, key)
             baseurls = sec.get("baseurl", [])
-            replacevars = getVars(releasever, arch, basearch)
             excludes = yumconf.get("main", {}).get("exclude", "")
             excludes += " " + sec.get("exclude", "")
             excludes = replaceVars(excludes, replacevars)
@@ -5422,7 +5983,7 @@ def readRepos(yumconfs, releasever, arch, readdebug,
             # lines to our baseurls, just like yum does.
             if "mirrorlist" in sec:
                 mirrorlist = sec["mirrorlist"]
-                baseurls.extend(readMirrorlist(mirrorlist, replacevars, key,
+                baseurls.extend(readMirrorlist(mirrorlist, replacevars,
                     verbose))
             if not baseurls:
                 print "%s:" % key, "No url for this section in conf file."
@@ -5431,6 +5992,7 @@ def readRepos(yumconfs, releasever, arch, readdebug,
             for i in xrange(len(baseurls)):
                 baseurls[i] = replaceVars(baseurls[i], replacevars)
             repo = RpmRepo(baseurls, excludes, verbose, key, readsrc, fast)
+            repo.urloptions = urloptions
             if repo.read(readgroupfile=readgroupfile) == 0:
                 print "Cannot read repo %s." % key
                 urloptions = setOptions()
@@ -5514,7 +6076,7 @@ def testMirrors(verbose, args):
     for (mirrorlist, releasever, arch, basearch) in args:
         print "---------------------------------------"
         replacevars = getVars(releasever, arch, basearch)
-        m = readMirrorlist([mirrorlist], replacevars, "testmirrors", verbose)
+        m = readMirrorlist([mirrorlist], replacevars, verbose)
         #print m
         if verbose > 2:
             for reponame in m:
@@ -5532,7 +6094,11 @@ def testMirrors(verbose, args):
 
 def writeFile(filename, data, mode=None):
     (fd, tmpfile) = mkstemp_file(pathdirname(filename), special=1)
-    fd.write("".join(data))
+    if isinstance(data, basestring):
+        fd.write(data)
+    else:
+        fd.writelines(data)
+    fd.close()
     if mode != None:
         os.chmod(tmpfile, mode & 07777)
     os.rename(tmpfile, filename)
@@ -5588,11 +6154,75 @@ def getChangeLogFromRpm(pkg, oldpkg):
     # Return the time of the first changelog entry in oldpkg:
     return (-1, oldpkg["changelogtime"][0])
 
-def cmpNoMD5(a, b):
-    """Ignore leading md5sum to sort the "sources" file."""
-    return cmp(a[33:], b[33:])
+def gitUpdateIndex(args, paths, cwd, env):
+    """Call git-update-index with args once for all paths, they are passed
+    on stdin, so their number is not limited by the command line."""
+    from subprocess import Popen, PIPE
+    p = Popen(["git-update-index"] + args + ["-z", "--stdin"], stdin=PIPE,
+        cwd=cwd, env=env)
+    data = "\0".join(paths)
+    if paths:
+        data += "\0"
+    p.communicate(data)
+    return p.returncode
+
+def gitOutput(args, cwd, env, stdin=None):
+    """Run git with args and return its output without the trailing
+    newline."""
+    from subprocess import Popen, PIPE
+    return Popen(["git"] + args, stdin=stdin, stdout=PIPE, cwd=cwd,
+        env=env).communicate()[0].rstrip("\n")
+
+# first line of a %changelog entry: "* Wed Jan 10 2007 name <email>"
+changelogrc = re.compile("^\*\s+\S+\s+(\S+)\s+(\d+)\s+(\d+)(?:\s|$)")
+monthnums = {"Jan": 1, "Feb": 2, "Mar": 3, "Apr": 4, "May": 5, "Jun": 6,
+    "Jul": 7, "Aug": 8, "Sep": 9, "Oct": 10, "Nov": 11, "Dec": 12}
+
+def getSpecChangeLogTime(specfile):
+    """Return the time of the first %changelog entry in specfile or None.
+    Only the lines up to this entry are read."""
+    fd = open(specfile, "r")
+    line = fd.readline()
+    while line and line != "%changelog\n":
+        line = fd.readline()
+    line = fd.readline()
+    fd.close()
+    m = changelogrc.match(line)
+    if not m:
+        return None
+    month = monthnums.get(m.group(1)[:3].capitalize())
+    day = int(m.group(2))
+    if month == None or day < 1 or day > 31:
+        return None
+    import calendar
+    return calendar.timegm((int(m.group(3)), month, day, 0, 0, 0, 0, 0, 0))
+
+# spec file -> (getStatKey(), md5sum) for spec files written by unpackSrpm()
+speccache = {}
+# filecache subdirs already created by unpackSrpm()
+filecachedirs = {}
 
 def extractSrpm(pkg, pkgdir, filecache, repodir, oldpkg):
+    changelog = unpackSrpm(pkg, pkgdir, filecache, repodir, oldpkg)
+    if changelog != None:
+        commitSrpm(pkg, pkgdir, repodir, oldpkg, changelog)
+
+def unpackSrpmTuple(args):
+    """Read the header of a src.rpm and call unpackSrpm() for a (filename,
+    pkgdir, filecache, repodir) tuple, this is used for
+    multiprocessing.Pool.imap()."""
+    (filename, pkgdir, filecache, repodir) = args
+    pkg = ReadRpm(filename)
+    if pkg.readHeader(rpmsigtag, rpmtag):
+        raise ValueError, "Cannot read %s" % filename
+    pkg.closeFd()
+    return unpackSrpm(pkg, pkgdir, filecache, repodir, None)
+
+def unpackSrpm(pkg, pkgdir, filecache, repodir, oldpkg):
+    """Unpack a src.rpm into pkgdir (binary files go into filecache) and
+    return the (changelognum, changelogtime) for commitSrpm() or None if
+    the package has not changed. No git commands are run, so several
+    packages can be unpacked in parallel."""
     pkgname = pkg["name"]
     files = pkg.getFilenames()
     i = pkg.getSpecfile(files)
@@ -5601,38 +6231,31 @@ def extractSrpm(pkg, pkgdir, filecache, repodir, oldpkg):
 
     (changelognum, changelogtime) = getChangeLogFromRpm(pkg, oldpkg)
     if os.path.exists(fullspecfile): # os.access(fullspecfile, os.R_OK)
-        checksum = getChecksum(fullspecfile)
+        # Spec files unpacked by us before are not read in again.
+        entry = speccache.get(fullspecfile)
+        if entry != None and entry[0] == getStatKey(fullspecfile):
+            checksum = entry[1]
+        else:
+            checksum = getChecksum(fullspecfile)
         # same spec file in repo and in rpm: nothing to do
         if checksum == pkg["filemd5s"][i]:
-            return
+            return None
         # If we don't have the previous package anymore, but there is still
         # a specfile, read the time of the last changelog entry.
         if changelognum == -1 and changelogtime == None:
-            l = open(fullspecfile, "r").readlines()
-            while l:
-                if l[0] == "%changelog\n":
-                    l.pop(0)
-                    break
-                l.pop(0)
-            if l:
-                l = l[0].split()
-            if l and l[0] == "*" and len(l) >= 5:
-                try:
-                    import calendar
-                    changelogtime = time.strptime(" ".join(l[1:5]),
-                        "%a %b %d %Y")
-                    changelogtime = calendar.timegm(changelogtime)
-                except:
-                    pass
-    os.system('rm -rf "%s"' % pkgdir)
+            changelogtime = getSpecChangeLogTime(fullspecfile)
+    import shutil
+    shutil.rmtree(pkgdir, 1)
     makeDirs(pkgdir)
     extractRpm(pkg, pkgdir + "/")
+    speccache[fullspecfile] = (getStatKey(fullspecfile), pkg["filemd5s"][i])
+    keep = {"Makefile": None, "sources": None}
+    for f in files:
+        keep[f] = None
+    prefix = pkgdir + "/"
     for f in os.listdir(pkgdir):
-        if f not in files and f not in ("Makefile", "sources"):
-            fsrc = pkgdir + "/" + f
-            os.unlink(fsrc)
-            os.system("cd %s/.. && GIT_DIR=%s git-update-index "
-                "--remove %s/%s" % (pkgdir, repodir, pkgname, f))
+        if f not in keep:
+            os.unlink(prefix + f)
     if "sources" in files or "Makefile" in files:
         raise ValueError, \
             "src.rpm contains sources/Makefile: %s" % pkg.filename
@@ -5650,39 +6273,81 @@ def extractSrpm(pkg, pkgdir, filecache, repodir, oldpkg):
         EXTRACT_SOURCE_FOR.remove("redhat-config-network")
     sources = []
     if filecache:
+        filemodes = pkg["filemodes"]
+        filemd5s = pkg["filemd5s"]
         for i in xrange(len(files)):
             f = files[i]
-            if not S_ISREG(pkg["filemodes"][i]) or not isBinary(f):
+            if not S_ISREG(filemodes[i]) or not isBinary(f):
                 continue
             fsrc = pkgdir + "/" + f
             # should we use sha instead of md5:
             #md5data = getChecksum(fsrc, "sha")
-            md5data = pkg["filemd5s"][i]
+            md5data = filemd5s[i]
             fdir = "%s/%s" % (filecache, md5data[0:2])
             fname = "%s/%s.bin" % (fdir, md5data)
-            if not os.path.exists(fname):
-                makeDirs(fdir)
-                doLnOrCopy(fsrc, fname)
+            # explodeFile() detects the tarball type from its name, so
+            # this has to be done before fsrc is moved to the filecache.
             if pkg["name"] in EXTRACT_SOURCE_FOR:
-                if fsrc.find(".tar") >= 0:
+                if f.find(".tar") >= 0:
                     tempdir = "%s/e.tar" % pkgdir
                     os.mkdir(tempdir)
                     dirname = explodeFile(fsrc, tempdir, "0")
                     os.rename(dirname, "%s/tar" % pkgdir)
                     os.rmdir(tempdir)
-            os.unlink(fsrc)
-            sources.append("%s %s\n" % (md5data, f))
-        sources.sort(cmpNoMD5)
+            if not os.path.exists(fname):
+                if fdir not in filecachedirs:
+                    makeDirs(fdir)
+                    filecachedirs[fdir] = None
+                # The unpacked file is not needed in pkgdir, so just
+                # move it over and only copy it if that is not possible.
+                try:
+                    os.rename(fsrc, fname)
+                except OSError:
+                    doLnOrCopy(fsrc, fname)
+                    os.unlink(fsrc)
+            else:
+                os.unlink(fsrc)
+            # Sort the "sources" file by filename, not by md5sum:
+            sources.append((f, "%s %s\n" % (md5data, f)))
+        sources.sort()
+        for i in xrange(len(sources)):
+            sources[i] = sources[i][1]
     writeFile(pkgdir + "/sources", sources)
     writeFile(pkgdir + "/Makefile", [
         "include ../pyrpm/Makefile.srpm\n",
         "NAME:=%s\nSPECFILE:=%s\n" % (pkg["name"], specfile)])
-    os.environ["GIT_DIR"] = repodir
-    os.system("cd %s/.. && { find %s -type f -print | xargs git-update-index "
-        "-q --add --refresh; }" % (pkgdir, pkgname))
-    os.system('cd %s/.. && { for file in $(git-ls-files); do [ ! -f "$file" ]'
-        ' &&  git-update-index --remove "$file"; done; }' % pkgdir)
-    del os.environ["GIT_DIR"]
+    return (changelognum, changelogtime)
+
+def commitSrpm(pkg, pkgdir, repodir, oldpkg, changelog):
+    """Commit the files unpacked by unpackSrpm() into the git repository
+    repodir."""
+    pkgname = pkg["name"]
+    (changelognum, changelogtime) = changelog
+    # All git commands run without a shell and with GIT_DIR only set
+    # for them, from the dir that holds all unpacked packages.
+    unpackdir = pathdirname(pkgdir)
+    gitenv = os.environ.copy()
+    gitenv["GIT_DIR"] = repodir
+    # Add all files of this package and remove all files of it from the
+    # index that are gone, each with one git call. Other packages might
+    # just be unpacked in parallel, so they are not looked at.
+    added = []
+    for (dirpath, _, filenames) in os.walk(pkgdir):
+        reldir = pkgname + dirpath[len(pkgdir):] + "/"
+        for f in filenames:
+            fsrc = dirpath + "/" + f
+            if os.path.isfile(fsrc) and not os.path.islink(fsrc):
+                added.append(reldir + f)
+    gitUpdateIndex(["-q", "--add", "--refresh"], added, unpackdir, gitenv)
+    from subprocess import Popen, PIPE
+    indexfiles = Popen(["git-ls-files", "-z", "--", pkgname], stdout=PIPE,
+        cwd=unpackdir, env=gitenv).communicate()[0].split("\0")[:-1]
+    removed = []
+    for f in indexfiles:
+        if not os.path.isfile(unpackdir + "/" + f):
+            removed.append(f)
+    if removed:
+        gitUpdateIndex(["--remove"], removed, unpackdir, gitenv)
     # Add changelog text:
     (fd, tmpfile) = mkstemp_file(tmpdir, special=1)
     fd.write("update to %s" % pkg.getNVR())
@@ -5695,7 +6360,6 @@ def extractSrpm(pkg, pkgdir, filecache, repodir, oldpkg):
     # python-only
     del fd
     # python-only-end
-    changelog = "-F " + tmpfile
     # Add a user name and email:
     user = "cvs@devel.redhat.com"
     email = user
@@ -5711,17 +6375,27 @@ def extractSrpm(pkg, pkgdir, filecache, repodir, oldpkg):
     # XXX if we monitor trees, we could change the checkin time to
     # first day of release of the rpm package instead of rpm buildtime
     buildtime = str(pkg.hdr.getOne("buildtime"))
-    os.system("cd " + repodir + " && GIT_AUTHOR_NAME=\"" + user + \
-        "\" GIT_AUTHOR_EMAIL=\"" + email + "\" GIT_AUTHOR_DATE=" + \
-        buildtime + " GIT_COMMITTER_NAME=\"" + user + \
-        "\" GIT_COMMITTER_EMAIL=\"" + email + "\" GIT_COMMITTER_DATE=" + \
-        buildtime + " GIT_DIR=" + repodir + " git commit " + changelog)
+    for who in ("AUTHOR", "COMMITTER"):
+        gitenv["GIT_%s_NAME" % who] = user
+        gitenv["GIT_%s_EMAIL" % who] = email
+        gitenv["GIT_%s_DATE" % who] = buildtime
+    # Commit with plumbing commands, "git commit" would first compare the
+    # work tree of all unpacked packages against the index.
+    tree = gitOutput(["write-tree"], unpackdir, gitenv)
+    parent = gitOutput(["rev-parse", "--verify", "-q", "HEAD"], unpackdir,
+        gitenv)
+    if tree and (not parent or
+        tree != gitOutput(["rev-parse", parent + "^{tree}"], unpackdir,
+        gitenv)):
+        args = ["commit-tree", tree]
+        if parent:
+            args.extend(["-p", parent])
+        commit = gitOutput(args, unpackdir, gitenv, open(tmpfile, "r"))
+        if commit:
+            gitOutput(["update-ref", "HEAD", commit], unpackdir, gitenv)
     if tmpfile != None:
         os.unlink(tmpfile)
 
-def cmpByTime(a, b):
-    return cmp(a["buildtime"][0], b["buildtime"][0])
-
 def createMercurial(verbose):
     if not os.path.isdir(grepodir) or not os.path.isdir(hgfiles):
         print "Error: Paths for mercurial not setup. " + grepodir \
@@ -5752,15 +6426,62 @@ def createMercurial(verbose):
             pkgs.extend(findRpms(d))
         pkgs = readRpm(pkgs, rpmsigtag, rpmtag)
         if firsttime:
-            pkgs.sort(cmpByTime)
+            # Sort by buildtime. The index keeps the sort stable and
+            # the packages themselves are never compared.
+            l = []
+            for i in xrange(len(pkgs)):
+                l.append((pkgs[i]["buildtime"][0], i, pkgs[i]))
+            l.sort()
+            pkgs = []
+            for (_, _, pkg) in l:
+                pkgs.append(pkg)
         else:
             pkgs = getPkgsNewest(pkgs)
+        # If each package name is only there once, all packages can be
+        # unpacked in parallel by worker processes if python-2.6
+        # multiprocessing is available. Only the git commits are done
+        # one after the other in this process. speccache and filecachedirs
+        # are filled in the workers and those changes are lost, so these
+        # caches only help when unpacking within this process.
+        try:
+            from multiprocessing import Pool
+        except ImportError:
+            Pool = None
+        pool = unpacked = None
+        if Pool != None and not firsttime and len(pkgs) > 1:
+            names = {}
+            args = []
+            for pkg in pkgs:
+                names[pkg["name"]] = None
+                args.append((pkg.filename, unpackdir + "/" + pkg["name"],
+                    filecache, repodir))
+            if len(names) == len(pkgs):
+                pool = Pool()
+                unpacked = pool.imap(unpackSrpmTuple, args)
         oldpkgs = {}
-        for pkg in pkgs:
-            pkgname = pkg["name"]
-            pkgdir = unpackdir + "/" + pkgname
-            extractSrpm(pkg, pkgdir, filecache, repodir, oldpkgs.get(pkgname))
-            oldpkgs[pkgname] = pkg
+        try:
+            for pkg in pkgs:
+                pkgname = pkg["name"]
+                pkgdir = unpackdir + "/" + pkgname
+                oldpkg = oldpkgs.get(pkgname)
+                if unpacked != None:
+                    changelog = unpacked.next()
+                else:
+                    changelog = unpackSrpm(pkg, pkgdir, filecache, repodir,
+                        oldpkg)
+                if changelog != None:
+                    commitSrpm(pkg, pkgdir, repodir, oldpkg, changelog)
+                oldpkgs[pkgname] = pkg
+        except:
+            # Stop the workers, they would go on unpacking otherwise.
+            err = sys.exc_info()
+            if pool != None:
+                pool.terminate()
+                pool.join()
+            raise err[0], err[1], err[2]
+        if pool != None:
+            pool.close()
+            pool.join()
         os.system("cd %s && { GIT_DIR=%s git repack -d; GIT_DIR=%s git "
             "prune-packed; }" % (unpackdir, repodir, repodir))
 
@@ -5771,18 +6492,19 @@ def checkDeps(rpms, checkfileconflicts, runorderer, verbose=0):
     # sorted order, so they are easier to read.
     # Add all packages in.
     if verbose > 3:
-        time1 = time.clock()
+        time1 = timer()
     resolver = RpmResolver(rpms, checkfileconflicts)
     if verbose > 3:
-        time2 = time.clock()
+        time2 = timer()
         print "- Needed", time2 - time1, "sec for RpmResolver()."
-        time1 = time.clock()
+        time1 = timer()
+    searchDependency = resolver.searchDependency
     # Check for obsoletes.
-    deps = resolver.obsoletes_list.keys()
+    deps = resolver.obsoletes_list.items()
     deps.sort()
-    for (name, flag, version) in deps:
-        orpms = resolver.obsoletes_list[(name, flag, version)]
-        for pkg in resolver.searchDependency(name, flag, version):
+    for (dep, orpms) in deps:
+        (name, flag, version) = dep
+        for pkg in searchDependency(name, flag, version):
             for rpm in orpms:
                 if rpm.getNEVR0() == pkg.getNEVR0():
                     continue
@@ -5792,34 +6514,39 @@ def checkDeps(rpms, checkfileconflicts, runorderer, verbose=0):
                     rpm.getFilename()
                 resolver.removePkg(pkg)
     # Check all conflicts.
-    conflicts = []
-    deps = resolver.conflicts_list.keys()
+    conflicts = {}
+    deps = resolver.conflicts_list.items()
     deps.sort()
-    for (name, flag, version) in deps:
-        orpms = resolver.conflicts_list[(name, flag, version)]
-        for pkg in resolver.searchDependency(name, flag, version):
+    for (dep, orpms) in deps:
+        (name, flag, version) = dep
+        for pkg in searchDependency(name, flag, version):
             for rpm in orpms:
                 if rpm.getNEVR0() == pkg.getNEVR0():
                     continue
                 print "Warning:", rpm.getFilename(), \
                     "contains a conflict with", pkg.getFilename()
-                conflicts.append((rpm, pkg))
-                conflicts.append((pkg, rpm))
-    # Check all requires.
-    deps = resolver.requires_list.keys()
-    deps.sort()
-    for (name, flag, version) in deps:
+                conflicts[(rpm, pkg)] = None
+                conflicts[(pkg, rpm)] = None
+    # Check all requires. Only the unresolved ones need to be sorted
+    # for the output.
+    missing = []
+    for (dep, rrpms) in resolver.requires_list.iteritems():
+        (name, flag, version) = dep
         if name[:7] == "rpmlib(":
             continue
-        if not resolver.searchDependency(name, flag, version):
-            for rpm in resolver.requires_list[(name, flag, version)]:
-                print "Warning:", rpm.getFilename(), \
-                    "did not find a package for:", \
-                    depString(name, flag, version)
+        if not searchDependency(name, flag, version):
+            missing.append((dep, rrpms))
+    missing.sort()
+    for (dep, rrpms) in missing:
+        (name, flag, version) = dep
+        for rpm in rrpms:
+            print "Warning:", rpm.getFilename(), \
+                "did not find a package for:", \
+                depString(name, flag, version)
     if verbose > 3:
-        time2 = time.clock()
+        time2 = timer()
         print "- Needed", time2 - time1, "sec for conflicts/requires/obsoletes."
-        time1 = time.clock()
+        time1 = timer()
     # Check for fileconflicts.
     if checkfileconflicts:
         dirnames = resolver.filenames_list.path.keys()
@@ -5844,9 +6571,9 @@ def checkDeps(rpms, checkfileconflicts, runorderer, verbose=0):
                         print y.getFilename(),
                     print
         if verbose > 3:
-            time2 = time.clock()
+            time2 = timer()
             print "- Needed", time2 - time1, "sec to check for symlinks with dirnames."
-            time1 = time.clock()
+            time1 = timer()
         # Now check for other fileconflicts:
         for dirname in dirnames:
             pathdirname2 = resolver.filenames_list.path[dirname]
@@ -5856,36 +6583,42 @@ def checkDeps(rpms, checkfileconflicts, runorderer, verbose=0):
                 s = pathdirname2[basename]
                 if len(s) < 2:
                     continue
+                # No fileconflict if mode/md5sum/user/group match.
+                # In addition also symlink linktos need to match.
+                # Collect this data once per file and only compare
+                # pairs if not all files are the same.
+                keys = []
+                colors = []
+                for (rpm, i) in s:
+                    filemodesi = rpm["filemodes"][i]
+                    filelinktosi = None
+                    if S_ISLNK(filemodesi):
+                        filelinktosi = rpm["filelinktos"][i]
+                    keys.append((rpm["filemd5s"][i], filemodesi,
+                        rpm["fileusername"][i], rpm["filegroupname"][i],
+                        filelinktosi))
+                    filecolorsi = None
+                    if rpm["filecolors"]:
+                        filecolorsi = rpm["filecolors"][i]
+                    colors.append(filecolorsi)
+                if keys.count(keys[0]) == len(keys):
+                    continue
                 # We could also only check with the next entry and then
                 # report one errror for a filename with all rpms listed.
                 for j in xrange(len(s) - 1):
-                    (rpm1, i1) = s[j]
-                    filemodesi1 = rpm1["filemodes"][i1]
-                    filemd5si1 = rpm1["filemd5s"][i1]
-                    filecolorsi1 = None
-                    if rpm1["filecolors"]:
-                        filecolorsi1 = rpm1["filecolors"][i1]
+                    key1 = keys[j]
+                    filecolorsi1 = colors[j]
                     for k in xrange(j + 1, len(s)):
-                        (rpm2, i2) = s[k]
-                        filemodesi2 = rpm2["filemodes"][i2]
-                        # No fileconflict if mode/md5sum/user/group match.
-                        # In addition also symlink linktos need to match.
-                        if (filemd5si1 == rpm2["filemd5s"][i2] and
-                            filemodesi1 == filemodesi2
-                            and rpm1["fileusername"][i1] ==
-                                rpm2["fileusername"][i2]
-                            and rpm1["filegroupname"][i1] ==
-                                rpm2["filegroupname"][i2]
-                            and (not S_ISLNK(filemodesi1) or
-                                 rpm1["filelinktos"][i1] ==
-                                 rpm2["filelinktos"][i2])):
+                        if keys[k] == key1:
                             continue
                         # No fileconflict for multilib elf32/elf64 files,
                         # both files need to be elf32 or elf64 files.
-                        if filecolorsi1 and rpm2["filecolors"]:
-                            filecolorsi2 = rpm2["filecolors"][i2]
-                            if filecolorsi2 and filecolorsi1 != filecolorsi2:
-                                continue
+                        filecolorsi2 = colors[k]
+                        if (filecolorsi1 and filecolorsi2 and
+                            filecolorsi1 != filecolorsi2):
+                            continue
+                        rpm1 = s[j][0]
+                        rpm2 = s[k][0]
                         # Mention which fileconflicts also have a real
                         # Conflicts: dependency within the packages:
                         kn = ""
@@ -5894,9 +6627,9 @@ def checkDeps(rpms, checkfileconflicts, runorderer, verbose=0):
                         print "fileconflict for", dirname + basename, "in", \
                             rpm1.getFilename(), "and", rpm2.getFilename(), kn
         if verbose > 3:
-            time2 = time.clock()
+            time2 = timer()
             print "- Needed", time2 - time1, "sec for fileconflicts."
-            time1 = time.clock()
+            time1 = timer()
     # Order rpms on how they get installed.
     if runorderer:
         orderer = RpmOrderer(resolver.rpms, {}, {}, [], resolver)
@@ -5904,9 +6637,9 @@ def checkDeps(rpms, checkfileconflicts, runorderer, verbose=0):
         if operations == None:
             raise
         if verbose > 3:
-            time2 = time.clock()
+            time2 = timer()
             print "- Needed", time2 - time1, "sec for rpm ordering."
-            time1 = time.clock()
+            time1 = timer()
         #print operations
 
 
@@ -5955,6 +6688,14 @@ def verifyStructure(verbose, packages, phash, tag, useidx=1):
             pkgtag = packages[tid]["basenames2"]
         else:
             pkgtag = packages[tid][tag]
+        if useidx:
+            # Compare all entries at once and only look at single
+            # entries if something is wrong:
+            try:
+                if map(pkgtag.__getitem__, mytag.keys()) == mytag.values():
+                    continue
+            except IndexError:
+                pass
         for (idx, mytagidx) in mytag.iteritems():
             if useidx:
                 try:
@@ -5963,6 +6704,7 @@ def verifyStructure(verbose, packages, phash, tag, useidx=1):
                     print "Error %s: index %s is not in package" % (tag, idx)
                     if verbose > 2:
                         print mytagidx
+                    continue
             else:
                 if idx != 0:
                     print "Error %s: index %s out of range" % (tag, idx)
@@ -5983,9 +6725,7 @@ def verifyStructure(verbose, packages, phash, tag, useidx=1):
             refhash = pkg[tag]
         if not refhash:
             continue
-        phashtid = None
-        if tid in phash:
-            phashtid = phash[tid]
+        phashtid = phash.get(tid)
         if not useidx:
             # Single entry with data:
             if phashtid != None and refhash != phashtid[0]:
@@ -5995,21 +6735,33 @@ def verifyStructure(verbose, packages, phash, tag, useidx=1):
                 if verbose > 2:
                     print "refhash:", refhash
             continue
+        if phashtid == None:
+            phashtid = {}
+        # All entries are copied over for most tags, so compare the
+        # complete data at once:
+        if tag not in ("group", "requirename", "filemd5s", "triggername") \
+            and phashtid == dict(zip(xrange(len(refhash)), refhash)):
+            continue
+        if tag == "filemd5s":
+            filemodes = pkg["filemodes"]
+            filesizes = pkg["filesizes"]
+        elif tag == "requirename":
+            requireflags = pkg["requireflags"]
         tnamehash = {}
         for idx in xrange(len(refhash)):
             key = refhash[idx]
             # Only one group entry is copied over.
             if tag == "group" and idx > 0:
-                continue
+                break
             # requirename only stored if not InstallPreReq
             if tag == "requirename":
-                if isInstallPreReq(pkg["requireflags"][idx]):
+                if isInstallPreReq(requireflags[idx]):
                     continue
             # only include filemd5s for regular files (and ignore
             # files with size 0 as broken kernels can generate then
             # rpm packages with missing md5sum files for size==0).
-            if tag == "filemd5s" and (not S_ISREG(pkg["filemodes"][idx]) or
-                (key == "" and pkg["filesizes"][idx] == 0)):
+            if tag == "filemd5s" and (not S_ISREG(filemodes[idx]) or
+                (key == "" and filesizes[idx] == 0)):
                 continue
             # We only need to store triggernames once per package.
             if tag == "triggername":
@@ -6017,14 +6769,13 @@ def verifyStructure(verbose, packages, phash, tag, useidx=1):
                     continue
                 tnamehash[key] = 1
             # Real check for the actual data:
-            try:
-                if phashtid[idx] != key:
-                    print "wrong data"
-            except IndexError:
+            if idx not in phashtid:
                 print "Error %s: index %s is not in package %s" % (tag,
                     idx, tid)
                 if verbose > 2:
                     print key, phashtid
+            elif phashtid[idx] != key:
+                print "wrong data"
 
 def readPackages(buildroot, rpmdbpath, verbose, keepdata=1, hdrtags=None):
     import bsddb
@@ -6057,13 +6808,14 @@ def readPackages(buildroot, rpmdbpath, verbose, keepdata=1, hdrtags=None):
         (tid, data) = db.first()
     except:
         return (packages, keyring, maxtid, pkgdata, swapendian)
+    tidfmt = swapendian + "I"
+    nextf = db.next
     while 1:
-        tid = unpack("%sI" % swapendian, tid)[0]
+        tid = unpack(tidfmt, tid)[0]
         if tid == 0:
-            maxtid = unpack("%sI" % swapendian, data)[0]
+            maxtid = unpack(tidfmt, data)[0]
         else:
-            fd = StringIO(data)
-            pkg = ReadRpm("rpmdb", fd=fd)
+            pkg = ReadRpm("rpmdb", fd=StringIO(data))
             pkg.readHeader(None, hdrtags, keepdata, 1)
             if pkg["name"] == "gpg-pubkey":
                 #for k in openpgp.parsePGPKeys(pkg["description"]):
@@ -6073,7 +6825,7 @@ def readPackages(buildroot, rpmdbpath, verbose, keepdata=1, hdrtags=None):
             if keepdata:
                 pkgdata[tid] = data
         try:
-            (tid, data) = db.next()
+            (tid, data) = nextf()
         except:
             break
     return (packages, keyring, maxtid, pkgdata, swapendian)
@@ -6089,21 +6841,28 @@ def readDb(swapendian, filename, dbtype="hash", dotid=None):
         (k, v) = db.first()
     except:
         return rethash
+    tidfmt = swapendian + "I"
+    setdefault = rethash.setdefault
+    nextf = db.next
     while 1:
         if dotid:
-            k = unpack("%sI" % swapendian, k)[0]
+            k = unpack(tidfmt, k)[0]
         #PY3: if k == b"\x00":
         if k == "\x00":
             k = ""
-        for i in xrange(0, len(v), 8):
-            (tid, idx) = unpack("%s2I" % swapendian, v[i:i + 8])
-            rethash.setdefault(tid, {})
-            if idx in rethash[tid]:
+        # Decode all (tid, idx) pairs of this key with one unpack():
+        n = len(v) / 4
+        data = unpack("%s%dI" % (swapendian, n), v)
+        for i in xrange(0, n, 2):
+            tid = data[i]
+            idx = data[i + 1]
+            tidhash = setdefault(tid, {})
+            if idx in tidhash:
                 print "ignoring duplicate idx: %s %d %d" % (k, tid, idx)
                 continue
-            rethash[tid][idx] = k
+            tidhash[idx] = k
         try:
-            (k, v) = db.next()
+            (k, v) = nextf()
         except:
             break
     return rethash
@@ -6169,17 +6928,17 @@ def readRpmdb(rpmdbpath, distroverpkg, releasever, configfiles, buildroot,
         print "Reading rpmdb, this can take some time..."
         print "Reading %sPackages..." % rpmdbpath
         if verbose > 2:
-            time1 = time.clock()
+            time1 = timer()
     (packages, keyring, maxtid, pkgdata, swapendian) = readPackages(buildroot,
         rpmdbpath, verbose)
     if verbose:
         if verbose > 2:
-            time2 = time.clock()
+            time2 = timer()
             print "Needed", time2 - time1, "seconds to read Packages", \
-                "(%d rpm packages)." % len(packages.keys())
+                "(%d rpm packages)." % len(packages)
         print "Reading the other files in %s..." % rpmdbpath
         if verbose > 2:
-            time1 = time.clock()
+            time1 = timer()
     # Read other rpmdb files:
     if verbose and sys.version_info < (2, 3):
         print "If you use python-2.2 you can get the harmless output:", \
@@ -6208,11 +6967,11 @@ def readRpmdb(rpmdbpath, distroverpkg, releasever, configfiles, buildroot,
     triggername = readDb(swapendian, rpmdbpath + "Triggername")
     if verbose:
         if verbose > 2:
-            time2 = time.clock()
+            time2 = timer()
             print "Needed", time2 - time1, "seconds to read the other files."
         print "Checking data integrity..."
         if verbose > 2:
-            time1 = time.clock()
+            time1 = timer()
     # Checking data integrity of the rpmdb:
     for tid in packages.iterkeys():
         if tid > maxtid:
@@ -6221,8 +6980,21 @@ def readRpmdb(rpmdbpath, distroverpkg, releasever, configfiles, buildroot,
     verifyStructure(verbose, packages, conflictname, "conflictname")
     verifyStructure(verbose, packages, dirnames, "dirnames")
     for x in filemd5s.itervalues():
-        for y in x.iterkeys():
-            x[y] = b2a_hex(x[y])
+        # Convert all checksums of one package with a single b2a_hex()
+        # call if they all have the same length:
+        keys = x.keys()
+        values = x.values()
+        width = len(values[0])
+        if width and map(len, values) == [width] * len(values):
+            hexdata = b2a_hex("".join(values))
+            width = width * 2
+            i = 0
+            for y in keys:
+                x[y] = hexdata[i:i + width]
+                i += width
+        else:
+            for y in keys:
+                x[y] = b2a_hex(x[y])
     verifyStructure(verbose, packages, filemd5s, "filemd5s")
     verifyStructure(verbose, packages, group, "group")
     verifyStructure(verbose, packages, installtid, "installtid")
@@ -6238,10 +7010,13 @@ def readRpmdb(rpmdbpath, distroverpkg, releasever, configfiles, buildroot,
     arch_hash = setMachineDistance(arch, archlist)
     checkdupes = {}
     checkevr = {}
+    checkdupesf = checkdupes.setdefault
+    checkevrf = checkevr.setdefault
     # Find out "arch" and set "checkdupes".
     for pkg in packages.itervalues():
+        pkgname = pkg["name"]
         if (not specifyarch and rpmdbpath != "/var/lib/rpm/" and
-            pkg["name"] in kernelpkgs):
+            pkgname in kernelpkgs):
             # This would apply if we e.g. go from i686 -> x86_64, but
             # would also go from i686 -> s390 if such a kernel would
             # accidentally be installed. Good enough for the normal case.
@@ -6250,27 +7025,28 @@ def readRpmdb(rpmdbpath, distroverpkg, releasever, configfiles, buildroot,
                 arch_hash = setMachineDistance(arch)
                 print "Change 'arch' setting to be:", arch
         # XXX This only checks the name, not the "Provides:":
-        if (yumconfs and pkg["name"] in distroverpkg and
+        if (yumconfs and pkgname in distroverpkg and
             pkg["version"] != releasever):
             print "releasever could also be", pkg["version"], "instead of", \
                 releasever
         if not pkg.isInstallonly():
-            checkdupes.setdefault("%s.%s" % (pkg["name"], pkg["arch"]),
-                []).append(pkg)
-            checkevr.setdefault("%s" % pkg["name"], []).append(pkg)
-    # Check "arch" and dupes:
+            checkdupesf((pkgname, pkg["arch"]), []).append(pkg)
+            checkevrf(pkgname, []).append(pkg)
+    # Check "arch" and dupes. This needs the final "arch" setting from
+    # above, so it cannot be done within the same loop:
+    archget = arch_hash.get
     for pkg in packages.itervalues():
-        if (pkg["name"] != "gpg-pubkey" and
-            arch_hash.get(pkg["arch"]) == None):
+        pkgname = pkg["name"]
+        parch = pkg["arch"]
+        if pkgname != "gpg-pubkey" and archget(parch) == None:
             print "Warning: did not expect package with this arch: %s" % \
                 pkg.getFilename()
-        if (pkg["arch"] != "noarch" and
-            "%s.noarch" % pkg["name"] in checkdupes):
+        if parch != "noarch" and (pkgname, "noarch") in checkdupes:
             print "Warning: noarch and arch-dependent package installed:", \
                 pkg.getFilename()
     for (pkg, value) in checkdupes.iteritems():
         if len(value) > 1:
-            print "Warning: more than one package installed for %s." % pkg
+            print "Warning: more than one package installed for %s.%s." % pkg
     for (pkg, value) in checkevr.iteritems():
         if len(value) <= 1:
             continue
@@ -6282,12 +7058,14 @@ def readRpmdb(rpmdbpath, distroverpkg, releasever, configfiles, buildroot,
                     " than", q.getFilename()
     # Read in repositories to compare packages:
     if verbose > 2 and configfiles:
-        time3 = time.clock()
+        time3 = timer()
     repos = readRepos(yumconfs, releasever, arch, 1, 0, verbose)
     if repos == None:
         return 1
     if verbose > 2 and configfiles:
-        print "Needed", time.clock() - time3, "seconds to read the repos."
+        print "Needed", timer() - time3, "seconds to read the repos."
+    #PY3: hdrmagic = b"\x8e\xad\xe8\x01\x00\x00\x00\x00"
+    hdrmagic = "\x8e\xad\xe8\x01\x00\x00\x00\x00"
     for (tid, pkg) in packages.iteritems():
         if pkg["name"] == "gpg-pubkey":
             continue
@@ -6365,19 +7143,17 @@ def readRpmdb(rpmdbpath, distroverpkg, releasever, configfiles, buildroot,
                 print "Warning: package", pkg.getFilename(), \
                     "does not have a sha1 checksum."
             continue
-        lead = pack("!8s2I", "\x8e\xad\xe8\x01\x00\x00\x00\x00",
-            indexNo, storeSize)
         ctx = sha1.new()
-        ctx.update(lead)
-        ctx.update(fmt)
-        ctx.update(fmt2)
-        if ctx.hexdigest() != sha1header:
+        ctx.update("".join([hdrmagic, pack("!2I", indexNo, storeSize), fmt,
+            fmt2]))
+        digest = ctx.hexdigest()
+        if digest != sha1header:
             print pkg.getFilename(), \
-                "bad sha1: %s / %s" % (sha1header, ctx.hexdigest())
+                "bad sha1: %s / %s" % (sha1header, digest)
     checkDeps(packages.values(), checkfileconflicts, 0)
     if verbose:
         if verbose > 2:
-            time2 = time.clock()
+            time2 = timer()
             print "Needed", time2 - time1, "seconds to check the rpmdb data."
         print "Done with checkrpmdb."
     return None
@@ -6431,9 +7207,6 @@ def checkSrpms(ignoresymlinks):
             else:
                 i += 1
 
-def cmpA(h1, h2):
-    return cmp(h1[0], h2[0])
-
 def checkArch(path, ignoresymlinks):
     print "Mark the arch where a src.rpm would not get built:\n"
     arch = ["i386", "x86_64", "ia64", "ppc", "s390", "s390x"]
@@ -6441,57 +7214,54 @@ def checkArch(path, ignoresymlinks):
     rpms = readRpm(rpms, rpmsigtag, rpmtag)
     # Only look at the newest src.rpms.
     h = {}
+    setdefault = h.setdefault
     for rpm in rpms:
-        h.setdefault(rpm["name"], []).append(rpm)
+        setdefault(rpm["name"], []).append(rpm)
     rpmnames = h.keys()
     rpmnames.sort()
     for r in rpmnames:
         h[r] = [selectNewestRpm(h[r], {}, 0)]
     # Print table of archs to look at.
     for i in xrange(len(arch) + 2):
-        s = ""
+        cols = []
         for a in arch:
             if len(a) > i:
-                s = "%s%s " % (s, a[i])
+                cols.append(a[i] + " ")
             else:
-                s = s + "  "
-        print "%29s  %s" % ("", s)
+                cols.append("  ")
+        print "%29s  %s" % ("", "".join(cols))
     showrpms = []
+    # bitmask if a srpm builds on all archs
+    allarchs = (1 << len(arch)) - 1
     for rp in rpmnames:
         srpm = h[rp][0]
-        builds = {}
-        showit = 0
-        n = 1
+        cols = []
         nn = 0
-        for a in arch:
-            if srpm.buildOnArch(a):
-                builds[a] = 1
-                nn += n
-            else:
-                builds[a] = 0
-                showit = 1
-            n = n + n
-        if showit:
-            showrpms.append((nn, builds, srpm))
-    showrpms.sort(cmpA)
-    for (_, builds, srpm) in showrpms:
-        s = ""
-        for a in arch:
-            if builds[a] == 1:
-                s = "%s  " % s
+        for i in xrange(len(arch)):
+            if srpm.buildOnArch(arch[i]):
+                cols.append("  ")
+                nn |= 1 << i
             else:
-                s = "%sx " % s
-        print "%29s  %s" % (srpm["name"], s)
+                cols.append("x ")
+        if nn != allarchs:
+            showrpms.append((nn, len(showrpms), "".join(cols), srpm["name"]))
+    showrpms.sort()
+    for (_, _, row, name) in showrpms:
+        print "%29s  %s" % (name, row)
 
 def checkSymlinks(repo):
     """Check for dangling symlinks."""
     allfiles = {}
     goodlinks = {}
     dangling = []
-    # collect all files
+    # collect all files (only "in allfiles" is used, so the filenames
+    # are also used as values to fill the dict with C-level calls)
+    update = allfiles.update
     for rpm in repo:
-        for f in rpm.filenames:
-            allfiles[f] = None
+        filenames = rpm.filenames
+        if filenames:
+            update(dict(zip(filenames, filenames)))
+    normpath = os.path.normpath
     for rpm in repo:
         if not rpm.filenames:
             continue
@@ -6501,7 +7271,11 @@ def checkSymlinks(repo):
                 continue
             if link[:1] != "/":
                 link = "%s/%s" % (pathdirname(f), link)
-            link = os.path.normpath(link)
+            # Most links are already normalized, only call normpath()
+            # if there are "." or ".." elements or too many slashes:
+            if (link.find("/.") != -1 or link.find("//") != -1 or
+                link[-1:] == "/"):
+                link = normpath(link)
             if link in allfiles:
                 goodlinks[f] = link
                 continue
@@ -6527,17 +7301,23 @@ def resolveLink(goodlinks, link):
 
 def checkDirs(repo):
     backupfile = re.compile(".*~$|.*#[^/]+#$")
+    # Matches all filenames any of the checks below could apply to,
+    # so that most files are only looked at by this one regex:
+    suspicious = re.compile("^/etc/init\.d/|^/usr/lib/debug|\.orig$|"
+        "\.orig\.gz$|/CVS$|~$|#[^/]+#$").search
     # collect all directories
     for rpm in repo:
         if not rpm.filenames:
             continue
+        isdebuginfo = rpm["name"].endswith("-debuginfo")
         for f in rpm.filenames:
+            if not suspicious(f):
+                continue
             # check if startup scripts are in wrong directory
             if f.startswith("/etc/init.d/") and not opensuse:
                 print "init.d:", rpm.filename, f
             # output any package having debug stuff included
-            if (not rpm["name"].endswith("-debuginfo") and
-                f.startswith("/usr/lib/debug")):
+            if not isdebuginfo and f.startswith("/usr/lib/debug"):
                 print "debug stuff in normal package:", rpm.filename, f
             # output files coming from patch:
             if (f.endswith(".orig") or f.endswith(".orig.gz")) and \
@@ -6552,14 +7332,16 @@ def checkDirs(repo):
 
 def checkProvides(repo):
     provides = {}
+    # Only the names of all requires are needed:
     requires = {}
+    setdefault = provides.setdefault
     for rpm in repo:
         for r in rpm.getRequires():
-            requires.setdefault(r[0], []).append(rpm.getFilename())
+            requires[r[0]] = None
         if not rpm.issrc:
             for p in rpm.getProvides():
-                provides.setdefault(p, []).append(rpm)
-    if provides.keys():
+                setdefault(p, []).append(rpm)
+    if provides:
         print "Duplicate provides:"
     for (p, value) in provides.iteritems():
         # only look at duplicate keys
@@ -6569,16 +7351,21 @@ def checkProvides(repo):
         if p[0] not in requires:
             continue
         x = []
+        names = {}
         for rpm in value:
             #x.append(rpm.getFilename())
-            if rpm["name"] not in x:
-                x.append(rpm["name"])
+            name = rpm["name"]
+            if name not in names:
+                names[name] = None
+                x.append(name)
         if len(x) <= 1:
             continue
         print p, x
 
 def checkScripts(repo):
     comment = re.compile("^\s*#")
+    varsubst = re.compile(".*\${.+%.+}")
+    datefmt = re.compile(".*date \'?\\+")
     for rpm in repo:
         for s in ("postin", "postun", "prein", "preun", "verifyscript"):
             data = rpm[s]
@@ -6599,7 +7386,7 @@ def checkScripts(repo):
                     if line.find("%") == -1 or comment.match(line):
                         continue
                     # ignore ${var%extension} constructs
-                    if re.compile(".*\${.+%.+}").match(line):
+                    if varsubst.match(line):
                         continue
                     # ignore "rpm --query --queryformat" and "rpm --eval"
                     if (line.find("rpm --query --queryformat") != -1 or
@@ -6609,7 +7396,7 @@ def checkScripts(repo):
                     #if line.find("-printf") != -1:
                     #    continue
                     # ignore `date +string`
-                    if re.compile(".*date \'?\\+").match(line):
+                    if datefmt.match(line):
                         continue
                     # openSuSE "kmp" rpms
                     if line.find("set --") != -1:
@@ -6981,103 +7768,117 @@ def main():
 
         # Read all packages in rpmdb.
         if verbose > 2:
-            time1 = time.clock()
+            time1 = timer()
         if verbose > 1:
             print "Reading the rpmdb in %s." % rpmdbpath
         (packages, keyring, maxtid, pkgdata, swapendian) = \
             readPackages(buildroot, rpmdbpath, verbose, 0, importanttags)
         if verbose > 2:
-            time2 = time.clock()
+            time2 = timer()
             print "Needed", time2 - time1, "seconds to read the rpmdb", \
-                "(%d rpm packages)." % len(packages.keys())
+                "(%d rpm packages)." % len(packages)
 
         # Read all repositories.
         if verbose > 2:
-            time1 = time.clock()
+            time1 = timer()
         repos = readRepos(yumconfs, releasever, arch, 1, 0, verbose, fast=0)
         if repos == None:
             return 1
         if verbose > 2:
-            time2 = time.clock()
+            time2 = timer()
             numrpms = 0
             for r in repos:
-                numrpms += len(r.pkglist.keys())
+                numrpms += len(r.pkglist)
             print "Needed", time2 - time1, "seconds to read the repos", \
                 "(%d rpm packages)." % numrpms
 
         # For timing purposes also read filelists:
         if verbose > 2:
-            time1 = time.clock()
+            time1 = timer()
+        # Download/checksum all filelists in parallel threads, they are
+        # then parsed one after the other.
+        if len(repos) > 1:
+            import threading
+            threads = []
+            for repo in repos:
+                t = threading.Thread(target=repo.cacheFilelist)
+                t.start()
+                threads.append(t)
+            for t in threads:
+                t.join()
         for repo in repos:
             repo.importFilelist()
         if verbose > 2:
-            time2 = time.clock()
+            time2 = timer()
             print "Needed", time2 - time1, "secs to read the repo filelists."
 
         # Sort repo packages to only keep the newest.
         if verbose > 2:
-            time1 = time.clock()
+            time1 = timer()
+        # getPkgsNewest() selects the newest rpms by name, so repo
+        # packages not matching the name of an installed package can
+        # be left out before sorting. They could never be an update.
+        installed = {}
+        for rpm in packages.itervalues():
+            installed[rpm["name"]] = None
         pkglist = []
         for r in repos:
-            pkglist.extend(r.pkglist.values())
+            for rpm in r.pkglist.itervalues():
+                if rpm["name"] in installed:
+                    pkglist.append(rpm)
         arch_hash = setMachineDistance(arch, archlist)
         pkglist = getPkgsNewest(pkglist, arch, arch_hash, verbose, 1)
         if verbose > 2:
-            time2 = time.clock()
+            time2 = timer()
             print "Needed", time2 - time1, "seconds to sort the repos."
 
         # XXX: Here we should also look at Obsoletes:
 
         # Select rpms to update:
         if verbose > 2:
-            time1 = time.clock()
+            time1 = timer()
         h = {}
+        setdefault = h.setdefault
+        hget = h.get
+        if exactarch:
+            archget = {}.get
+        else:
+            archget = buildarchtranslate.get
         # Read all packages from rpmdb, then add all newer packages
         # from the repositories. This oder makes sure rpmdb packages
         # are selected over their same versions in the repos.
         for rpm in packages.itervalues():
-            if rpm["name"] == "gpg-pubkey":
+            name = rpm["name"]
+            if name == "gpg-pubkey":
                 continue
             rarch = rpm["arch"]
-            if not exactarch:
-                rarch = buildarchtranslate.get(rarch, rarch)
-            h.setdefault( (rpm["name"], rarch) , []).append(rpm)
+            setdefault((name, archget(rarch, rarch)), []).append(rpm)
         for rpm in pkglist:
             rarch = rpm["arch"]
-            if not exactarch:
-                rarch = buildarchtranslate.get(rarch, rarch)
-            key = (rpm["name"], rarch)
-            if key in h:
-                h[key].append(rpm)
+            r = hget((rpm["name"], archget(rarch, rarch)))
+            if r != None:
+                r.append(rpm)
         # Now select which rpms to install/erase:
         installrpms = []
         eraserpms = []
         for r in h.itervalues():
-            if r[0].isInstallonly():
+            # an installed rpm is always the first entry
+            oldrpm = r[0]
+            if oldrpm.isInstallonly():
                 # XXX check if there is a newer "kernel" around
                 continue
+            # Without any repo rpm there is nothing to select:
+            if len(r) == 1:
+                continue
             newest = selectNewestRpm(r, arch_hash, verbose)
-            if newest == r[0]:
+            if newest == oldrpm:
                 continue
-            eraserpms.append(r[0])
+            eraserpms.append(oldrpm)
             installrpms.append(newest)
-        # Check noarch constraints.
-        #if None:
-        #  for rpms in h.itervalues():
-        #    newest = selectNewestRpm(rpms, arch_hash, verbose)
-        #    if newest["arch"] == "noarch":
-        #        for r in rpms:
-        #            if r != newest:
-        #                pkgs.remove(r)
-        #    else:
-        #        for r in rpms:
-        #            if r["arch"] == "noarch":
-        #                pkgs.remove(r)
-        #installrpms = getPkgsNewest(rtree.getPkgs(), arch, arch_hash,
-        #    verbose, 0)
+        # XXX: Also check noarch constraints like getPkgsNewest() does.
         #checkDeps(installrpms, checkfileconflicts, runorderer)
         if verbose > 2:
-            time2 = time.clock()
+            time2 = timer()
             print "Needed", time2 - time1, "seconds to check for updates."
         if verbose > 1:
             if not installrpms:
@@ -7092,13 +7893,13 @@ def main():
             if small:
                 hdrtags = importanttags
         if configfiles and verbose > 2:
-            time1 = time.clock()
+            time1 = timer()
         (yumconfs, distroverpkg, releasever) = readYumConf(configfiles,
             reposdirs, verbose, buildroot, rpmdbpath, distroverpkg,
             releasever)
         repos = readRepos(yumconfs, releasever, arch, 0, 1, verbose)
         if configfiles and verbose > 2:
-            time2 = time.clock()
+            time2 = timer()
             print "Needed", time2 - time1, "seconds to read the repos."
         if repos == None:
             return 1
@@ -7106,15 +7907,43 @@ def main():
         for r in repos:
             for p in r.pkglist.itervalues():
                 args.append(p.filename)
-                if p["rpm:header-range:end"]:
-                    headerend[p.filename] = p["rpm:header-range:end"]
-        time1 = time.clock()
+                end = p["rpm:header-range:end"]
+                if end:
+                    headerend[p.filename] = end
+        time1 = timer()
         checkarchs = []
+        # If the rpms are not kept for further checks, they are verified
+        # in parallel by worker processes if python-2.6 multiprocessing
+        # is available.
+        keeprpms = checkdeps or completerepo or strict or wait
+        try:
+            from multiprocessing import Pool
+        except ImportError:
+            Pool = None
+        useimportanttags = hdrtags is importanttags
+        pool = None
         for a in args:
             a = Uri2Filename(a)
             b = [a]
             if not a.endswith(".rpm") and not isUrl(a) and os.path.isdir(a):
                 b = findRpms(a, ignoresymlinks)
+            if Pool != None and not keeprpms and len(b) > 1:
+                # python-only
+                pargs = [ (a, verify, strict, payload, nodigest,
+                    useimportanttags, keepdata, headerend.get(a)) for a in b ]
+                # python-only-end
+                # pyrex-code
+                #pargs = []
+                #for a in b:
+                #    pargs.append((a, verify, strict, payload, nodigest,
+                #        useimportanttags, keepdata, headerend.get(a)))
+                # pyrex-code-end
+                if pool == None:
+                    pool = Pool()
+                # imap() returns the output in the order of the rpms:
+                for out in pool.imap(verifyRpmTuple, pargs, 16):
+                    sys.stdout.write(out)
+                continue
             for a in b:
                 #print a
                 rpm = verifyRpm(a, verify, strict, payload, nodigest, hdrtags,
@@ -7125,7 +7954,7 @@ def main():
                 #if f:
                 #    print rpm.getFilename()
                 #    print f
-                if checkdeps or completerepo or strict or wait:
+                if keeprpms:
                     if (rpm["name"] in kernelpkgs and not rpm.issrc and
                         rpm["arch"] not in checkarchs):
                         checkarchs.append(rpm["arch"])
@@ -7133,8 +7962,11 @@ def main():
                 # python-only
                 del rpm
                 # python-only-end
+        if pool != None:
+            pool.close()
+            pool.join()
         if verbose > 2:
-            time2 = time.clock()
+            time2 = timer()
             print "Needed", time2 - time1, "seconds to read", len(repo), \
                 "rpm packages."
         if strict:
@@ -7152,7 +7984,7 @@ def main():
                     excludes = excludes.strip(" \t,;")
                     excludes = excludes.split(" \t,;")
                 for arch in checkarchs:
-                    time1 = time.clock()
+                    time1 = timer()
                     print "Check as if kernel has the", \
                         "architecture \"%s\" now:" % arch
                     arch_hash = setMachineDistance(arch, archlist)
@@ -7167,7 +7999,7 @@ def main():
                         checkProvides(installrpms)
                     checkDeps(installrpms, checkfileconflicts, runorderer,
                         verbose)
-                    time2 = time.clock()
+                    time2 = timer()
                     print "Needed", time2 - time1, "sec to check this tree."
             else:
                 print "No arch defined to check, are kernels missing?"
@@ -7175,8 +8007,15 @@ def main():
             checkRepo(repo)
 
     if wait:
+        # Keep all data in memory for some time, e.g. to look at the
+        # memory usage. PYRPM_WAIT can change the default of 30 seconds.
+        try:
+            waitsecs = int(os.environ.get("PYRPM_WAIT", "30"))
+        except ValueError:
+            waitsecs = 30
         print "Ready."
-        time.sleep(30)
+        if waitsecs > 0:
+            time.sleep(waitsecs)
     return 0
 
 def run_main(mymain):
@@ -7185,21 +8024,34 @@ def run_main(mymain):
         dohotshot = 1
         sys.argv.pop(1)
     if dohotshot:
-        import hotshot, hotshot.stats
-        htfilename = mkstemp_file(tmpdir)[1]
-        prof = hotshot.Profile(htfilename)
-        prof.runcall(mymain)
-        prof.close()
-        # python-only
-        del prof
-        # python-only-end
-        print "Starting profil statistics. This takes some time..."
-        s = hotshot.stats.load(htfilename)
+        try:
+            # python-2.5 and newer: profiler in C, no temp file needed
+            import cProfile, pstats
+        except ImportError:
+            cProfile = None
+        htfilename = None
+        if cProfile != None:
+            prof = cProfile.Profile()
+            prof.runcall(mymain)
+            print "Starting profil statistics. This takes some time..."
+            s = pstats.Stats(prof)
+        else:
+            import hotshot, hotshot.stats
+            htfilename = mkstemp_file(tmpdir)[1]
+            prof = hotshot.Profile(htfilename)
+            prof.runcall(mymain)
+            prof.close()
+            # python-only
+            del prof
+            # python-only-end
+            print "Starting profil statistics. This takes some time..."
+            s = hotshot.stats.load(htfilename)
         s.strip_dirs()
         s.sort_stats("time").print_stats(100)
         s.sort_stats("cumulative").print_stats(100)
         s.sort_stats("calls").print_stats(100)
-        os.unlink(htfilename)
+        if htfilename != None:
+            os.unlink(htfilename)
     else:
         ret = mymain()
         if ret != None: